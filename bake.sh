@@ -0,0 +1,28 @@
+#!/bin/bash
+
+# Strip per-cluster state from this node so that it can be registered as an AMI by
+# the bake-ami action. Instances launched from the image only need the cluster
+# topology written out and the daemons started.
+
+pushd ${HOME}/hadoop-ec2 > /dev/null
+
+source ${HOME}/.bashrc
+source ${HOME}/.bash_profile
+source ec2-variables.sh
+
+for module in ${MODULES}; do
+  if [[ -e ${module}/bake.sh ]]; then
+    echo "Stripping cluster state from $module"
+    source ${module}/bake.sh
+  fi
+  cd ${HOME}/hadoop-ec2  # guard against bake.sh changing the cwd
+done
+
+echo "Removing cluster hostnames, hosts entries and SSH keys..."
+rm -f ec2-variables.sh masters slaves topology.data hosts
+sudo sed -i '/^# BEGIN hadoop-ec2 cluster$/,/^# END hadoop-ec2 cluster$/d' /etc/hosts
+rm -rf ${HOME}/.hadoop-ec2-state
+rm -f ~/.ssh/id_rsa ~/.ssh/id_rsa.pub ~/.ssh/authorized_keys ~/.ssh/known_hosts
+echo "localhost" | sudo tee /etc/hostname > /dev/null
+
+popd > /dev/null
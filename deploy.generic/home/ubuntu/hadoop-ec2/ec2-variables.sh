@@ -19,6 +19,12 @@
 
 export MASTERS="{{master_list}}"
 export SLAVES="{{slave_list}}"
+export DATANODES="{{datanode_list}}"
+export COMPUTE_NODES="{{compute_list}}"
+export EXPECTED_BLOCKS="{{expected_blocks}}"
 export MODULES="{{modules}}"
+export BAKED_IMAGE="{{baked_image}}"
+export CLUSTER_INSTANCES="{{cluster_instances}}"
+export SCRIPTS_VERSION="{{scripts_version}}"
 export AWS_ACCESS_KEY_ID="{{aws_access_key_id}}"
 export AWS_SECRET_ACCESS_KEY="{{aws_secret_access_key}}"
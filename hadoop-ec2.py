@@ -1,21 +1,25 @@
+import array
+import hashlib
 import itertools
+import json
 import logging
+import math
 import os
 import pipes
 import shutil
+import socket
 import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
 import time
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from stat import S_IRUSR
 from sys import stderr
 
-import boto
-from boto import ec2
-
 if sys.version < "3":
     pass
 else:
@@ -29,69 +33,172 @@ HADOOP_EC2_DIR = os.path.dirname(os.path.realpath(__file__))
 AWS_REGION = 'us-west-2'
 AWS_AZ = 'us-west-2c'
 HADOOP_USER = 'ubuntu'
-
-EC2_INSTANCE_TYPES = {
-    "c1.medium": "pvm",
-    "c1.xlarge": "pvm",
-    "c3.large": "hvm",
-    "c3.xlarge": "hvm",
-    "c3.2xlarge": "hvm",
-    "c3.4xlarge": "hvm",
-    "c3.8xlarge": "hvm",
-    "c4.large": "hvm",
-    "c4.xlarge": "hvm",
-    "c4.2xlarge": "hvm",
-    "c4.4xlarge": "hvm",
-    "c4.8xlarge": "hvm",
-    "cc1.4xlarge": "hvm",
-    "cc2.8xlarge": "hvm",
-    "cg1.4xlarge": "hvm",
-    "cr1.8xlarge": "hvm",
-    "d2.xlarge": "hvm",
-    "d2.2xlarge": "hvm",
-    "d2.4xlarge": "hvm",
-    "d2.8xlarge": "hvm",
-    "g2.2xlarge": "hvm",
-    "g2.8xlarge": "hvm",
-    "hi1.4xlarge": "pvm",
-    "hs1.8xlarge": "pvm",
-    "i2.xlarge": "hvm",
-    "i2.2xlarge": "hvm",
-    "i2.4xlarge": "hvm",
-    "i2.8xlarge": "hvm",
-    "m1.small": "pvm",
-    "m1.medium": "pvm",
-    "m1.large": "pvm",
-    "m1.xlarge": "pvm",
-    "m2.xlarge": "pvm",
-    "m2.2xlarge": "pvm",
-    "m2.4xlarge": "pvm",
-    "m3.medium": "hvm",
-    "m3.large": "hvm",
-    "m3.xlarge": "hvm",
-    "m3.2xlarge": "hvm",
-    "m4.large": "hvm",
-    "m4.xlarge": "hvm",
-    "m4.2xlarge": "hvm",
-    "m4.4xlarge": "hvm",
-    "m4.10xlarge": "hvm",
-    "r3.large": "hvm",
-    "r3.xlarge": "hvm",
-    "r3.2xlarge": "hvm",
-    "r3.4xlarge": "hvm",
-    "r3.8xlarge": "hvm",
-    "t1.micro": "pvm",
-    "t2.micro": "hvm",
-    "t2.small": "hvm",
-    "t2.medium": "hvm",
-    "t2.large": "hvm",
-}
+HADOOP_EC2_MODULES = ['hadoop', 'hive']
+
+# Tags set on AMIs registered by bake-ami, listing the modules already set up on them
+# and the version of the hadoop-ec2 scripts baked in with them.
+BAKED_MODULES_TAG = 'hadoop-ec2:baked-modules'
+BAKED_SCRIPTS_VERSION_TAG = 'hadoop-ec2:scripts-version'
+
+# Local overrides for the instance catalog and the results of past benchmark runs.
+HADOOP_EC2_STATE_DIR = os.path.expanduser('~/.hadoop-ec2')
+
+# Fields of each EC2_INSTANCE_CATALOG entry: AMI virtualization type, vCPUs, memory (GiB),
+# number of instance store disks, size of each disk (GB), disk kind ('hdd', 'ssd' or None
+# for EBS-only), network performance, whether the type supports SR-IOV enhanced networking,
+# and the Linux on-demand price per hour in AWS_REGION (USD).
+EC2_INSTANCE_FIELDS = ('virtualization', 'vcpus', 'memory_gb', 'disks', 'disk_gb', 'disk_type',
+                       'network', 'enhanced_networking', 'price')
+
+# Sources: http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/InstanceStorage.html
+#          https://aws.amazon.com/ec2/pricing/
+# Last Updated: 2015-06-19
+# Entries can be overridden or added with --instance-catalog, a JSON object mapping each
+# instance type to an object with the fields above.
+# For easy maintainability, please keep this manually-inputted dictionary sorted by key.
+EC2_INSTANCE_CATALOG = dict((name, dict(zip(EC2_INSTANCE_FIELDS, spec))) for name, spec in {
+    "c1.medium": ("pvm", 2, 1.7, 1, 350, "hdd", "moderate", False, 0.130),
+    "c1.xlarge": ("pvm", 8, 7, 4, 420, "hdd", "high", False, 0.520),
+    "c3.large": ("hvm", 2, 3.75, 2, 16, "ssd", "moderate", True, 0.105),
+    "c3.xlarge": ("hvm", 4, 7.5, 2, 40, "ssd", "moderate", True, 0.210),
+    "c3.2xlarge": ("hvm", 8, 15, 2, 80, "ssd", "high", True, 0.420),
+    "c3.4xlarge": ("hvm", 16, 30, 2, 160, "ssd", "high", True, 0.840),
+    "c3.8xlarge": ("hvm", 32, 60, 2, 320, "ssd", "10g", True, 1.680),
+    "c4.large": ("hvm", 2, 3.75, 0, 0, None, "moderate", True, 0.110),
+    "c4.xlarge": ("hvm", 4, 7.5, 0, 0, None, "high", True, 0.220),
+    "c4.2xlarge": ("hvm", 8, 15, 0, 0, None, "high", True, 0.441),
+    "c4.4xlarge": ("hvm", 16, 30, 0, 0, None, "high", True, 0.882),
+    "c4.8xlarge": ("hvm", 36, 60, 0, 0, None, "10g", True, 1.763),
+    "cc1.4xlarge": ("hvm", 16, 23, 2, 840, "hdd", "10g", False, 1.300),
+    "cc2.8xlarge": ("hvm", 32, 60.5, 4, 840, "hdd", "10g", False, 2.000),
+    "cg1.4xlarge": ("hvm", 16, 22.5, 2, 840, "hdd", "10g", False, 2.100),
+    "cr1.8xlarge": ("hvm", 32, 244, 2, 120, "ssd", "10g", False, 3.500),
+    "d2.xlarge": ("hvm", 4, 30.5, 3, 2000, "hdd", "moderate", True, 0.690),
+    "d2.2xlarge": ("hvm", 8, 61, 6, 2000, "hdd", "high", True, 1.380),
+    "d2.4xlarge": ("hvm", 16, 122, 12, 2000, "hdd", "high", True, 2.760),
+    "d2.8xlarge": ("hvm", 36, 244, 24, 2000, "hdd", "10g", True, 5.520),
+    "g2.2xlarge": ("hvm", 8, 15, 1, 60, "ssd", "high", False, 0.650),
+    "g2.8xlarge": ("hvm", 32, 60, 2, 120, "ssd", "10g", False, 2.600),
+    "hi1.4xlarge": ("pvm", 16, 60.5, 2, 1024, "ssd", "10g", False, 3.100),
+    "hs1.8xlarge": ("pvm", 16, 117, 24, 2000, "hdd", "10g", False, 4.600),
+    "i2.xlarge": ("hvm", 4, 30.5, 1, 800, "ssd", "moderate", True, 0.853),
+    "i2.2xlarge": ("hvm", 8, 61, 2, 800, "ssd", "high", True, 1.705),
+    "i2.4xlarge": ("hvm", 16, 122, 4, 800, "ssd", "high", True, 3.410),
+    "i2.8xlarge": ("hvm", 32, 244, 8, 800, "ssd", "10g", True, 6.820),
+    "m1.small": ("pvm", 1, 1.7, 1, 160, "hdd", "low", False, 0.044),
+    "m1.medium": ("pvm", 1, 3.75, 1, 410, "hdd", "moderate", False, 0.087),
+    "m1.large": ("pvm", 2, 7.5, 2, 420, "hdd", "moderate", False, 0.175),
+    "m1.xlarge": ("pvm", 4, 15, 4, 420, "hdd", "high", False, 0.350),
+    "m2.xlarge": ("pvm", 2, 17.1, 1, 420, "hdd", "moderate", False, 0.245),
+    "m2.2xlarge": ("pvm", 4, 34.2, 1, 850, "hdd", "moderate", False, 0.490),
+    "m2.4xlarge": ("pvm", 8, 68.4, 2, 840, "hdd", "high", False, 0.980),
+    "m3.medium": ("hvm", 1, 3.75, 1, 4, "ssd", "moderate", False, 0.067),
+    "m3.large": ("hvm", 2, 7.5, 1, 32, "ssd", "moderate", False, 0.133),
+    "m3.xlarge": ("hvm", 4, 15, 2, 40, "ssd", "high", False, 0.266),
+    "m3.2xlarge": ("hvm", 8, 30, 2, 80, "ssd", "high", False, 0.532),
+    "m4.large": ("hvm", 2, 8, 0, 0, None, "moderate", True, 0.126),
+    "m4.xlarge": ("hvm", 4, 16, 0, 0, None, "high", True, 0.252),
+    "m4.2xlarge": ("hvm", 8, 32, 0, 0, None, "high", True, 0.504),
+    "m4.4xlarge": ("hvm", 16, 64, 0, 0, None, "high", True, 1.008),
+    "m4.10xlarge": ("hvm", 40, 160, 0, 0, None, "10g", True, 2.520),
+    "r3.large": ("hvm", 2, 15.25, 1, 32, "ssd", "moderate", True, 0.175),
+    "r3.xlarge": ("hvm", 4, 30.5, 1, 80, "ssd", "moderate", True, 0.350),
+    "r3.2xlarge": ("hvm", 8, 61, 1, 160, "ssd", "high", True, 0.700),
+    "r3.4xlarge": ("hvm", 16, 122, 1, 320, "ssd", "high", True, 1.400),
+    "r3.8xlarge": ("hvm", 32, 244, 2, 320, "ssd", "10g", True, 2.800),
+    "t1.micro": ("pvm", 1, 0.613, 0, 0, None, "low", False, 0.020),
+    "t2.micro": ("hvm", 1, 1, 0, 0, None, "low", False, 0.013),
+    "t2.small": ("hvm", 1, 2, 0, 0, None, "low", False, 0.026),
+    "t2.medium": ("hvm", 2, 4, 0, 0, None, "low", False, 0.052),
+    "t2.large": ("hvm", 2, 8, 0, 0, None, "low", False, 0.104),
+}.items())
+
+# Rough per-node scan rates used by the plan action when no benchmark result is stored
+# for an instance type, in MB/s.
+DISK_SCAN_MB_PER_SEC = {"hdd": 100, "ssd": 400}
+VCPU_SCAN_MB_PER_SEC = 60
+NETWORK_MB_PER_SEC = {"low": 10, "moderate": 40, "high": 120, "10g": 1100}
+
+# Fraction of raw instance storage the plan action lets HDFS fill, leaving room for
+# intermediate and temporary data. HDFS is only stored on instance store disks, so the
+# plan leaves out EBS-only types.
+HDFS_USABLE_FRACTION = 0.75
+
+# Smallest slave the plan action will recommend: room for a 4 GB YARN container
+# alongside the DataNode and NodeManager daemons.
+PLAN_MIN_MEMORY_GB = 7.5
+
+# Spot request status codes after which a diversified spot fleet gives up on the
+# instance pool (instance type and subnet) and asks the others for the capacity instead.
+SPOT_POOL_FAILURE_CODES = ["capacity-not-available", "capacity-oversubscribed",
+                           "price-too-low", "constraint-not-fulfillable", "bad-parameters"]
+
+# Number of busiest nodes the status action lists by disk and by container usage.
+STATUS_HOTTEST_NODES = 5
+
+# Directories collect-logs gathers from every node: the Hadoop daemon, GC and YARN
+# container logs, and Hive's logs in the Hadoop user's temp dir.
+COLLECT_LOG_DIRS = [HADOOP_HOME + '/logs', '/tmp/' + HADOOP_USER]
+
+# Tags recording which --node-groups group a slave was launched in and its role in it
+NODE_GROUP_TAG = 'hadoop-ec2:node-group'
+NODE_ROLE_TAG = 'hadoop-ec2:role'
+# datanode slaves run a DataNode and a NodeManager, compute slaves only a NodeManager
+NODE_ROLES = ['datanode', 'compute']
+
+# Most EC2 calls that take a list of instance ids accept at most this many at a time
+EC2_MAX_INSTANCE_IDS_PER_CALL = 100
+
+# Error codes returned while a security group is still referenced by something that has
+# not finished going away, and how long to keep retrying its deletion
+GROUP_DEPENDENCY_ERRORS = ["DependencyViolation", "InvalidGroup.InUse"]
+GROUP_DELETE_TIMEOUT = 300
+
+# How long to keep retrying to tag a newly registered AMI that EC2 doesn't know of yet
+IMAGE_TAG_TIMEOUT = 300
+
+# Where each node keeps markers of the setup work it has done, relative to its home
+# directory. It lives outside the script tree so that copying the scripts never resets it.
+NODE_STATE_DIR = '.hadoop-ec2-state'
+
+# Actions that take arguments after the cluster name.
+ACTIONS_WITH_ARGS = ["stage", "exec"]
+
+# Unix socket that serve listens on, and the actions that are forwarded to it when it's
+# running. The others prompt for confirmation or make no use of the connections serve
+# keeps open, and stay local.
+SERVE_SOCKET = os.path.join(HADOOP_EC2_STATE_DIR, 'serve.sock')
+SERVED_ACTIONS = ["get-master", "status", "exec"]
+SERVE_MAX_REQUEST_BYTES = 65536
+
+# Options naming local files, which serve resolves against the client's directory
+SERVED_PATH_OPTIONS = ["identity_file", "instance_catalog", "benchmark_file"]
+
+# The client stdout and stderr of the serve request each thread works on, if any
+SERVED_STREAMS = threading.local()
+
+# EC2 calls that serve answers from its inventory cache, and the call name prefixes that
+# may change a cluster and so clear the cache.
+EC2_CACHED_CALLS = ["get_all_reservations", "get_all_images"]
+EC2_MUTATING_CALL_PREFIXES = ("run_", "request_", "cancel_", "start_", "stop_", "reboot_",
+                              "terminate_", "create_", "delete_", "modify_")
+
+# EC2 error codes returned when a zone is out of capacity for an instance type.
+EC2_CAPACITY_ERRORS = ["InsufficientInstanceCapacity", "InsufficientCapacity"]
 
 
 class UsageError(Exception):
     pass
 
 
+class LaunchError(Exception):
+    """
+    Instances could not be launched. Any that the failed call did launch are already
+    terminated.
+    """
+    pass
+
+
 def stringify_command(parts):
     if isinstance(parts, str):
         return parts
@@ -99,11 +206,22 @@ def stringify_command(parts):
         return ' '.join(map(pipes.quote, parts))
 
 
+# boto is imported only once a command runs here, so that the commands forwarded to
+# serve don't pay for importing it.
+def connect_to_ec2():
+    from boto import ec2
+    return ec2.connect_to_region(AWS_REGION)
+
+
 def ssh_args(opts):
     parts = ['-o', 'StrictHostKeyChecking=no']
     parts += ['-o', 'UserKnownHostsFile=/dev/null']
     if opts.identity_file is not None:
         parts += ['-i', opts.identity_file]
+    # Set by serve, to reuse one SSH connection per node across commands
+    if opts.ssh_control_path is not None:
+        parts += ['-o', 'ControlMaster=auto', '-o', 'ControlPath=' + opts.ssh_control_path]
+        parts += ['-o', 'ControlPersist={s}'.format(s=opts.control_persist)]
     return parts
 
 
@@ -235,7 +353,7 @@ def is_cluster_ssh_available(cluster_instances, opts):
     Check if SSH is available on all the instances in a cluster.
     """
     for i in cluster_instances:
-        dns_name = get_dns_name(i)
+        dns_name = get_dns_name(i, opts.private_ips)
         if not is_ssh_available(host=dns_name, opts=opts):
             return False
     else:
@@ -253,94 +371,254 @@ def get_or_make_group(conn, name, vpc_id):
         return conn.create_security_group(name, "Hadoop group", vpc_id)
 
 
+# Get the EC2 cluster placement group of the given name, creating it if it doesn't exist
+def get_or_make_placement_group(conn, name):
+    groups = conn.get_all_placement_groups()
+    group = [g for g in groups if g.name == name]
+    if len(group) > 0:
+        return group[0]
+    else:
+        print("Creating cluster placement group " + name)
+        conn.create_placement_group(name, strategy='cluster')
+        return [g for g in conn.get_all_placement_groups() if g.name == name][0]
+
+
+def check_enhanced_networking(image, instance_types):
+    """
+    Warn if the AMI or any of the instance types can't use enhanced networking, which
+    is what gives instances in a cluster placement group their full bandwidth.
+    """
+    if getattr(image, 'sriov_net_support', None) != 'simple':
+        print("WARNING: AMI {a} does not have enhanced networking (sriovNetSupport) "
+              "enabled".format(a=image.id), file=stderr)
+    for instance_type in instance_types:
+        spec = get_instance_spec(instance_type)
+        if spec is None or not spec['enhanced_networking']:
+            print("WARNING: Instance type {t} does not support enhanced networking".format(
+                t=instance_type), file=stderr)
+
+
 # Gets the IP address
 def get_ip_address(instance):
     return instance.ip_address
 
 
-# Gets the DNS name
-def get_dns_name(instance):
-    dns = instance.public_dns_name
+# Get the address we reach an instance at from here: its public DNS name, or its private
+# IP address with --private-ips when running from inside the VPC
+def get_dns_name(instance, private_ips=False):
+    dns = instance.public_dns_name if not private_ips else instance.private_ip_address
     if not dns:
-        raise UsageError("Failed to determine hostname of {0}.".format(instance))
+        raise UsageError("Failed to determine hostname of {0}.\n"
+                         "Please check that you provided --private-ips if "
+                         "necessary".format(instance))
     return dns
 
 
+def get_cluster_address(instance, opts):
+    """
+    Get the address the other nodes of the cluster reach an instance at, which is
+    what the masters/slaves lists and the Hadoop configuration refer to it by.
+    """
+    address = {
+        'public-dns': instance.public_dns_name,
+        'private-dns': instance.private_dns_name,
+        'private-ip': instance.private_ip_address,
+    }[opts.cluster_addressing]
+    if not address:
+        raise UsageError("Failed to determine the {m} address of {i}.".format(
+            m=opts.cluster_addressing, i=instance))
+    return address
+
+
+def get_hosts_entries(instances):
+    """
+    Build the /etc/hosts lines that let every node resolve the private names of the
+    others without going through DNS.
+    """
+    lines = []
+    for i in instances:
+        if i.private_ip_address and i.private_dns_name:
+            lines.append('{ip} {dns} {short}'.format(
+                ip=i.private_ip_address, dns=i.private_dns_name,
+                short=i.private_dns_name.split('.')[0]))
+    return '\n'.join(lines)
+
+
+def get_instance_spec(instance_type):
+    return EC2_INSTANCE_CATALOG.get(instance_type)
+
+
+def get_rack(instance):
+    """
+    Get the network location HDFS and YARN should see for an instance: its availability
+    zone, then its placement group or subnet. All racks have the same depth, as HDFS requires.
+    """
+    return '/{z}/{r}'.format(
+        z=instance.placement,
+        r=instance.placement_group or instance.subnet_id or 'default-rack')
+
+
+def get_topology_map(instances):
+    """
+    Map every address a node may be known by in the cluster to its rack, one
+    "<address> <rack>" pair per line, for hadoop/topology.sh to look up.
+    """
+    lines = []
+    for i in instances:
+        rack = get_rack(i)
+        for address in (i.private_ip_address, i.private_dns_name, i.ip_address, i.public_dns_name):
+            if address:
+                lines.append('{a} {r}'.format(a=address, r=rack))
+    return '\n'.join(lines)
+
+
 def get_num_disks(instance_type):
-    # Source: http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/InstanceStorage.html
-    # Last Updated: 2015-06-19
-    # For easy maintainability, please keep this manually-inputted dictionary sorted by key.
-    disks_by_instance = {
-        "c1.medium": 1,
-        "c1.xlarge": 4,
-        "c3.large": 2,
-        "c3.xlarge": 2,
-        "c3.2xlarge": 2,
-        "c3.4xlarge": 2,
-        "c3.8xlarge": 2,
-        "c4.large": 0,
-        "c4.xlarge": 0,
-        "c4.2xlarge": 0,
-        "c4.4xlarge": 0,
-        "c4.8xlarge": 0,
-        "cc1.4xlarge": 2,
-        "cc2.8xlarge": 4,
-        "cg1.4xlarge": 2,
-        "cr1.8xlarge": 2,
-        "d2.xlarge": 3,
-        "d2.2xlarge": 6,
-        "d2.4xlarge": 12,
-        "d2.8xlarge": 24,
-        "g2.2xlarge": 1,
-        "g2.8xlarge": 2,
-        "hi1.4xlarge": 2,
-        "hs1.8xlarge": 24,
-        "i2.xlarge": 1,
-        "i2.2xlarge": 2,
-        "i2.4xlarge": 4,
-        "i2.8xlarge": 8,
-        "m1.small": 1,
-        "m1.medium": 1,
-        "m1.large": 2,
-        "m1.xlarge": 4,
-        "m2.xlarge": 1,
-        "m2.2xlarge": 1,
-        "m2.4xlarge": 2,
-        "m3.medium": 1,
-        "m3.large": 1,
-        "m3.xlarge": 2,
-        "m3.2xlarge": 2,
-        "m4.large": 0,
-        "m4.xlarge": 0,
-        "m4.2xlarge": 0,
-        "m4.4xlarge": 0,
-        "m4.10xlarge": 0,
-        "r3.large": 1,
-        "r3.xlarge": 1,
-        "r3.2xlarge": 1,
-        "r3.4xlarge": 1,
-        "r3.8xlarge": 2,
-        "t1.micro": 0,
-        "t2.micro": 0,
-        "t2.small": 0,
-        "t2.medium": 0,
-        "t2.large": 0,
-    }
-    if instance_type in disks_by_instance:
-        return disks_by_instance[instance_type]
+    spec = get_instance_spec(instance_type)
+    if spec is not None:
+        return spec['disks']
     else:
         print("WARNING: Don't know number of disks on instance type %s; assuming 1"
               % instance_type, file=stderr)
         return 1
 
 
-def get_existing_cluster(conn, cluster_name, die_on_error=True):
+def get_block_device_map(instance_type):
+    """
+    Map all the instance store disks of instance_type, which EC2 only attaches when
+    asked to. hadoop/mount-disks.sh formats and mounts them on the nodes for HDFS.
+    """
+    from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
+    block_map = BlockDeviceMapping()
+    for i in range(get_num_disks(instance_type)):
+        device = BlockDeviceType()
+        device.ephemeral_name = 'ephemeral%d' % i
+        # The first instance store disk is /dev/sdb
+        block_map['/dev/sd' + chr(ord('b') + i)] = device
+    return block_map
+
+
+def load_instance_catalog(path):
+    """
+    Merge the instance types described in a local JSON file into EC2_INSTANCE_CATALOG.
+    Fields left out of an entry keep their built-in values, so new types need them all.
+    """
+    with open(path) as f:
+        overrides = json.load(f)
+    for instance_type, spec in overrides.items():
+        unknown = set(spec) - set(EC2_INSTANCE_FIELDS)
+        if unknown:
+            raise UsageError("Unknown fields {f} for {t} in instance catalog {p}".format(
+                f=', '.join(sorted(unknown)), t=instance_type, p=path))
+        if instance_type not in EC2_INSTANCE_CATALOG:
+            missing = set(EC2_INSTANCE_FIELDS) - set(spec)
+            if missing:
+                raise UsageError("Missing fields {f} for {t} in instance catalog {p}".format(
+                    f=', '.join(sorted(missing)), t=instance_type, p=path))
+        merged = dict(EC2_INSTANCE_CATALOG.get(instance_type, {}), **spec)
+        for field in ('vcpus', 'memory_gb', 'disks', 'disk_gb', 'price'):
+            if not isinstance(merged[field], (int, float)) or merged[field] < 0:
+                raise UsageError("Invalid {f} {v!r} for {t} in instance catalog {p}".format(
+                    f=field, v=merged[field], t=instance_type, p=path))
+        if merged['disks'] and merged['disk_type'] not in DISK_SCAN_MB_PER_SEC:
+            raise UsageError("Invalid disk_type {v!r} for {t} in instance catalog {p}, "
+                             "expected one of {e}".format(
+                                 v=merged['disk_type'], t=instance_type, p=path,
+                                 e=', '.join(sorted(DISK_SCAN_MB_PER_SEC))))
+        if merged['network'] not in NETWORK_MB_PER_SEC:
+            raise UsageError("Invalid network {v!r} for {t} in instance catalog {p}, "
+                             "expected one of {e}".format(
+                                 v=merged['network'], t=instance_type, p=path,
+                                 e=', '.join(sorted(NETWORK_MB_PER_SEC))))
+        EC2_INSTANCE_CATALOG[instance_type] = merged
+
+
+def load_benchmarks(path):
+    """
+    Load stored benchmark results, a JSON object mapping instance types to measured
+    per-node figures, e.g. {"d2.2xlarge": {"scan_mb_per_sec": 540}}.
+    """
+    if path is None or not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_scan_rate(instance_type, benchmarks):
+    """
+    Get the per-node scan throughput in MB/s for an instance type, and whether it came
+    from a stored benchmark result or was estimated from the instance catalog.
+    """
+    if 'scan_mb_per_sec' in benchmarks.get(instance_type, {}):
+        rate = benchmarks[instance_type]['scan_mb_per_sec']
+        if not isinstance(rate, (int, float)) or rate <= 0:
+            raise UsageError("Invalid scan_mb_per_sec {r!r} for {t} in the benchmark file.".format(
+                r=rate, t=instance_type))
+        return rate, 'benchmark'
+    spec = EC2_INSTANCE_CATALOG[instance_type]
+    if spec['disks']:
+        io_rate = spec['disks'] * DISK_SCAN_MB_PER_SEC[spec['disk_type']]
+    else:
+        # EBS-only types read their HDFS blocks over the network
+        io_rate = NETWORK_MB_PER_SEC[spec['network']]
+    return min(io_rate, spec['vcpus'] * VCPU_SCAN_MB_PER_SEC), 'estimate'
+
+
+def plan_cluster(opts):
+    """
+    Recommend an instance type and slave count that can hold --data-size GB of data at
+    --replication and scan it at --scan-throughput MB/s or within --time-budget seconds.
+    Candidates are printed cheapest first.
+    """
+    if opts.data_size is None:
+        raise UsageError("The plan action requires --data-size.")
+    if opts.time_budget is not None:
+        if opts.time_budget <= 0:
+            raise UsageError("--time-budget must be positive.")
+        target_rate = opts.data_size * 1024.0 / opts.time_budget
+    elif opts.scan_throughput is not None:
+        target_rate = opts.scan_throughput
+    else:
+        raise UsageError("The plan action requires --scan-throughput or --time-budget.")
+
+    benchmarks = load_benchmarks(opts.benchmark_file)
+    stored_gb = opts.data_size * opts.replication
+    candidates = []
+    for instance_type, spec in EC2_INSTANCE_CATALOG.items():
+        if spec['vcpus'] is None or spec['price'] is None or not spec['disks'] or \
+                spec['memory_gb'] < PLAN_MIN_MEMORY_GB:
+            continue
+        rate, source = get_scan_rate(instance_type, benchmarks)
+        usable_gb = spec['disks'] * spec['disk_gb'] * HDFS_USABLE_FRACTION
+        slaves = max(opts.replication, int(math.ceil(target_rate / rate)),
+                     int(math.ceil(stored_gb / usable_gb)))
+        candidates.append((slaves * spec['price'], instance_type, slaves, rate * slaves,
+                           slaves * usable_gb, source))
+    if not candidates:
+        raise UsageError("No instance type in the catalog has instance store disks, vCPUs, "
+                         "a price and at least {m} GB of memory.".format(m=PLAN_MIN_MEMORY_GB))
+    candidates.sort()
+
+    print("Planning for {d} GB at replication {r}, scanning at {t:.0f} MB/s".format(
+        d=opts.data_size, r=opts.replication, t=target_rate))
+    print("{0:<14} {1:>6} {2:>9} {3:>10} {4:>10} {5:>9} {6:>10}".format(
+        "type", "slaves", "$/hour", "scan MB/s", "scan time", "HDFS GB", "rate from"))
+    for cost, instance_type, slaves, rate, hdfs_gb, source in candidates[:10]:
+        print("{0:<14} {1:>6} {2:>9.2f} {3:>10.0f} {4:>9.0f}s {5:>9.0f} {6:>10}".format(
+            instance_type, slaves, cost, rate, opts.data_size * 1024.0 / rate, hdfs_gb, source))
+    cost, instance_type, slaves = candidates[0][:3]
+    print("Recommended: {s} x {t} slaves (${c:.2f}/hour)".format(
+        s=slaves, t=instance_type, c=cost))
+
+
+def get_existing_cluster(conn, cluster_name, die_on_error=True, quiet=False):
     """
     Get the EC2 instances in an existing cluster if available.
     Returns a tuple of lists of EC2 instance objects for the masters and slaves.
+    With quiet, only errors are printed, e.g. to keep machine-readable output clean.
     """
-    print("Searching for existing cluster {c} in region {r}...".format(
-        c=cluster_name, r=AWS_REGION))
+    if not quiet:
+        print("Searching for existing cluster {c} in region {r}...".format(
+            c=cluster_name, r=AWS_REGION))
 
     def get_instances(group_names):
         """
@@ -356,7 +634,7 @@ def get_existing_cluster(conn, cluster_name, die_on_error=True):
     master_instances = get_instances([cluster_name + "-master"])
     slave_instances = get_instances([cluster_name + "-slaves"])
 
-    if any((master_instances, slave_instances)):
+    if any((master_instances, slave_instances)) and not quiet:
         print("Found {m} master{plural_m}, {s} slave{plural_s}.".format(
             m=len(master_instances),
             plural_m=('' if len(master_instances) == 1 else 's'),
@@ -371,6 +649,146 @@ def get_existing_cluster(conn, cluster_name, die_on_error=True):
     return master_instances, slave_instances
 
 
+def chunk_instances(instances):
+    """
+    Split instances into lists small enough to pass to a single EC2 call.
+    """
+    return [instances[i:i + EC2_MAX_INSTANCE_IDS_PER_CALL]
+            for i in range(0, len(instances), EC2_MAX_INSTANCE_IDS_PER_CALL)]
+
+
+def change_instance_states(conn, action, instances):
+    """
+    Stop, start, terminate or reboot instances with as few EC2 calls as possible.
+    action: one of 'stop', 'start', 'terminate' or 'reboot'
+    Instances that are already shutting down or terminated are skipped.
+    """
+    instances = [i for i in instances if i.state not in ["shutting-down", "terminated"]]
+    call = getattr(conn, action + '_instances')
+    for batch in chunk_instances(instances):
+        call(instance_ids=[i.id for i in batch])
+    return instances
+
+
+def delete_security_groups(conn, group_names):
+    """
+    Delete the named security groups, retrying while EC2 still considers them in use
+    (e.g. by instances that are only just terminated). Returns True if all were deleted.
+    """
+    from boto.exception import EC2ResponseError
+    deadline = time.time() + GROUP_DELETE_TIMEOUT
+    delay = 1
+    while True:
+        groups = conn.get_all_security_groups(filters={'group-name': group_names})
+        groups = [g for g in groups if g.name in group_names]
+        # Delete individual rules in all groups before deleting groups to
+        # remove dependencies between them
+        for group in groups:
+            for rule in group.rules:
+                for grant in rule.grants:
+                    group.revoke(ip_protocol=rule.ip_protocol,
+                                 from_port=rule.from_port,
+                                 to_port=rule.to_port,
+                                 src_group=grant)
+
+        in_use = []
+        for group in groups:
+            try:
+                # It is needed to use group_id to make it work with VPC
+                conn.delete_security_group(group_id=group.id)
+                print("Deleted security group %s" % group.name)
+            except EC2ResponseError as e:
+                if e.error_code not in GROUP_DEPENDENCY_ERRORS:
+                    print("Failed to delete security group {g}: {e}".format(
+                        g=group.name, e=e.error_message), file=stderr)
+                    return False
+                in_use.append(group.name)
+
+        if not in_use:
+            return True
+        if time.time() + delay > deadline:
+            print("Security groups still in use: " + ", ".join(in_use), file=stderr)
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 10)
+
+
+def refresh_instances(conn, instances):
+    """
+    Refresh the state of instances in place, a batch per EC2 call rather than one call
+    each, and return the status checks of those that are running.
+    """
+    statuses = []
+    for batch in chunk_instances(instances):
+        ids = [i.id for i in batch]
+        fresh = dict((i.id, i) for i in conn.get_only_instances(instance_ids=ids))
+        for i in batch:
+            if i.id in fresh:
+                i._update(fresh[i.id])
+        statuses.extend(conn.get_all_instance_status(instance_ids=ids))
+    return statuses
+
+
+def get_ready_instances(conn, opts, instances):
+    """
+    Get the ids of the instances that are running, pass their status checks and accept
+    SSH connections. The SSH checks run in parallel.
+    """
+    statuses = dict((s.id, s) for s in refresh_instances(conn, instances))
+    candidates = [i for i in instances if i.state == 'running' and i.id in statuses and
+                  statuses[i.id].system_status.status == 'ok' and
+                  statuses[i.id].instance_status.status == 'ok']
+    reachable = run_on_hosts(
+        candidates, opts,
+        lambda i: is_ssh_available(get_dns_name(i, opts.private_ips), opts, print_ssh_output=False))
+    return set(i.id for i, ok in zip(candidates, reachable) if ok)
+
+
+def wait_for_quorum(conn, opts, master_nodes, slave_nodes):
+    """
+    Wait until the master and all the slaves are ssh-ready or, once opts.ready_deadline
+    seconds have passed, until the master and opts.ready_fraction of the slaves are.
+    Returns the slaves that are ready and the ones that are not. Without a ready master
+    there is no cluster to set up, so past the deadline that is an error.
+    """
+    sys.stdout.write("Waiting for the master and {p:.0%} of the slaves to become ready.".format(
+        p=opts.ready_fraction))
+    sys.stdout.flush()
+
+    start_time = time.time()
+    needed = int(math.ceil(opts.ready_fraction * len(slave_nodes)))
+    num_attempts = 0
+
+    while True:
+        time.sleep(5 * min(num_attempts, 6))  # seconds
+
+        ready = get_ready_instances(conn, opts, master_nodes + slave_nodes)
+        ready_slaves = [i for i in slave_nodes if i.id in ready]
+        past_deadline = time.time() - start_time > opts.ready_deadline
+        if all(i.id in ready for i in master_nodes):
+            if len(ready_slaves) == len(slave_nodes):
+                break
+            if past_deadline and len(ready_slaves) >= needed:
+                break
+        elif past_deadline:
+            sys.stdout.write("\n")
+            raise UsageError(
+                "Master {m} is not ready after {t:.0f} seconds. Destroy the cluster and "
+                "launch it again.".format(
+                    m=', '.join(i.id for i in master_nodes if i.id not in ready),
+                    t=time.time() - start_time))
+
+        num_attempts += 1
+
+        sys.stdout.write(".")
+        sys.stdout.flush()
+
+    sys.stdout.write("\n")
+    print("{r} of {n} slaves are ready after {t:.0f} seconds.".format(
+        r=len(ready_slaves), n=len(slave_nodes), t=time.time() - start_time))
+    return ready_slaves, [i for i in slave_nodes if i.id not in ready]
+
+
 def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
     """
     Wait for all the instances in the cluster to reach a designated state.
@@ -389,14 +807,7 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
     while True:
         time.sleep(5 * num_attempts)  # seconds
 
-        for i in cluster_instances:
-            i.update()
-
-        max_batch = 100
-        statuses = []
-        for j in range(0, len(cluster_instances), max_batch):
-            batch = [i.id for i in cluster_instances[j:j + max_batch]]
-            statuses.extend(conn.get_all_instance_status(instance_ids=batch))
+        statuses = refresh_instances(conn, cluster_instances)
 
         if cluster_state == 'ssh-ready':
             if all(i.state == 'running' for i in cluster_instances) and \
@@ -422,6 +833,314 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
     ))
 
 
+# Launch count on-demand instances, trying each of instance_types in turn. When EC2
+# runs out of capacity the request is retried in successively smaller batches, and
+# once single instances can't be placed we fall back to the next instance type. If all
+# of them fall short, the instances launched so far are terminated and LaunchError raised.
+def run_instances(image, opts, count, instance_types, security_group_ids, placement_group=None):
+    from boto.exception import EC2ResponseError
+    instances = []
+    for instance_type in instance_types:
+        batch = count - len(instances)
+        while len(instances) < count:
+            batch = min(batch, count - len(instances))
+            try:
+                res = image.run(
+                    key_name=opts.key_pair,
+                    security_group_ids=security_group_ids,
+                    instance_type=instance_type,
+                    block_device_map=get_block_device_map(instance_type),
+                    placement=AWS_AZ,
+                    placement_group=placement_group,
+                    min_count=batch,
+                    max_count=batch,
+                    subnet_id=opts.subnet_id,
+                    instance_profile_name=opts.instance_profile_name)
+            except EC2ResponseError as e:
+                if e.error_code not in EC2_CAPACITY_ERRORS:
+                    raise
+                if batch == 1:
+                    print("No {t} capacity left in {z}".format(t=instance_type, z=AWS_AZ),
+                          file=stderr)
+                    break
+                batch = max(1, batch // 2)
+                print("Insufficient {t} capacity in {z}, retrying in batches of {b}".format(
+                    t=instance_type, z=AWS_AZ, b=batch), file=stderr)
+                continue
+            instances += res.instances
+            print("Launched {n} {t} instance{plural} in {z}, regid = {r}".format(
+                n=len(res.instances),
+                t=instance_type,
+                plural=('' if len(res.instances) == 1 else 's'),
+                z=AWS_AZ,
+                r=res.id))
+        if len(instances) == count:
+            return instances
+
+    if instances:
+        print("Terminating the {n} instances launched of the {c} needed...".format(
+            n=len(instances), c=count), file=stderr)
+        change_instance_states(image.connection, 'terminate', instances)
+    raise LaunchError("Could only launch {n} of {c} instances of type {t}".format(
+        n=len(instances), c=count, t=', '.join(instance_types)))
+
+
+def get_capacity_units(instance_type, base_type):
+    """
+    Get how many base_type instances one instance_type is worth, by whichever of its
+    vCPUs or memory is proportionally smaller. Unknown types count as one.
+    """
+    spec = get_instance_spec(instance_type)
+    base = get_instance_spec(base_type)
+    if spec is None or base is None:
+        return 1.0
+    return min(float(spec['vcpus']) / base['vcpus'], float(spec['memory_gb']) / base['memory_gb'])
+
+
+def parse_spot_pools(opts):
+    """
+    Expand --spot-instance-types ("type[:weight],...") and --spot-subnets into the
+    list of (instance_type, weight, subnet_id) pools a diversified spot fleet uses.
+    Types without an explicit weight are weighted by get_capacity_units().
+    """
+    types = []
+    for entry in opts.spot_instance_types.split(','):
+        if not entry:
+            continue
+        if ':' in entry:
+            instance_type, weight = entry.split(':', 1)
+            weight = float(weight)
+        else:
+            instance_type = entry
+            weight = get_capacity_units(instance_type, opts.instance_type)
+        if weight <= 0:
+            raise UsageError("Spot instance type {t} has no capacity (weight {w}).".format(
+                t=instance_type, w=weight))
+        types.append((instance_type, weight))
+    subnets = [s for s in opts.spot_subnets.split(',') if s] or [opts.subnet_id]
+    return [(t, w, s) for (t, w) in types for s in subnets]
+
+
+def get_node_groups(opts):
+    """
+    Get the groups of slaves to launch from --node-groups
+    ("name=type:count[:role[:spot_price]],..."), or else the one group of --slaves
+    --instance-type slaves. Each group is a dict of its name, instance_types (to try in
+    order), count, role and spot_price (None for on-demand).
+    """
+    if not opts.node_groups:
+        return [dict(name='default',
+                     instance_types=[opts.instance_type] + opts.alternate_instance_types,
+                     count=opts.slaves,
+                     role='datanode',
+                     spot_price=opts.spot_price)]
+
+    groups = []
+    for entry in opts.node_groups.split(','):
+        if not entry:
+            continue
+        try:
+            name, spec = entry.split('=', 1)
+            fields = spec.split(':')
+            group = dict(name=name,
+                         instance_types=[fields[0]],
+                         count=int(fields[1]),
+                         role=fields[2] if len(fields) > 2 and fields[2] else 'datanode',
+                         spot_price=float(fields[3]) if len(fields) > 3 and fields[3] else None)
+        except (ValueError, IndexError):
+            raise UsageError("Invalid node group {e}, expected "
+                             "name=type:count[:role[:spot_price]].".format(e=entry))
+        if group['role'] not in NODE_ROLES:
+            raise UsageError("Node group {n} has role {r}, expected one of {roles}.".format(
+                n=name, r=group['role'], roles=', '.join(NODE_ROLES)))
+        groups.append(group)
+    return groups
+
+
+def get_node_role(instance):
+    # Slaves launched before node groups existed all hold HDFS blocks
+    return instance.tags.get(NODE_ROLE_TAG, 'datanode')
+
+
+def tag_slaves(slave_nodes, cluster_name, group):
+    for slave in slave_nodes:
+        slave.add_tags({
+            'Name': '{cn}-slave-{iid}'.format(cn=cluster_name, iid=slave.id),
+            NODE_GROUP_TAG: group['name'],
+            NODE_ROLE_TAG: group['role'],
+        })
+
+
+def cancel_spot_requests(conn, req_ids):
+    """
+    Cancel spot instance requests after a failure, and terminate any instances they
+    already launched.
+    """
+    if not req_ids:
+        return
+    print("Canceling spot instance requests", file=stderr)
+    conn.cancel_spot_instance_requests(req_ids)
+    launched = [r.instance_id for r in conn.get_all_spot_instance_requests(request_ids=req_ids)
+                if r.instance_id]
+    if launched:
+        print("Terminating the {n} instances they launched...".format(n=len(launched)),
+              file=stderr)
+        conn.terminate_instances(instance_ids=launched)
+
+
+# Request a group's slaves as spot instances of its first instance type at its price,
+# and wait for all of them to be granted.
+def request_spot_slaves(conn, opts, cluster_name, slave_group, group, placement_group):
+    print("Requesting %d slaves as spot instances with price $%.3f" % (group['count'], group['spot_price']))
+    my_req_ids = []
+    slave_reqs = conn.request_spot_instances(
+        price=group['spot_price'],
+        image_id=opts.ami,
+        launch_group="launch-group-%s-%s" % (cluster_name, group['name']),
+        placement=AWS_AZ,
+        placement_group=placement_group,
+        count=group['count'],
+        key_name=opts.key_pair,
+        security_group_ids=[slave_group.id],
+        instance_type=group['instance_types'][0],
+        block_device_map=get_block_device_map(group['instance_types'][0]),
+        subnet_id=opts.subnet_id,
+        instance_profile_name=opts.instance_profile_name)
+    my_req_ids += [req.id for req in slave_reqs]
+
+    print("Waiting for spot instances to be granted...")
+    try:
+        while True:
+            time.sleep(10)
+            reqs = conn.get_all_spot_instance_requests()
+            id_to_req = {}
+            for r in reqs:
+                id_to_req[r.id] = r
+            active_instance_ids = []
+            for i in my_req_ids:
+                if i in id_to_req and id_to_req[i].state == "active":
+                    active_instance_ids.append(id_to_req[i].instance_id)
+            if len(active_instance_ids) == group['count']:
+                print("All %d slaves granted" % group['count'])
+                reservations = conn.get_all_reservations(active_instance_ids)
+                slave_nodes = []
+                for r in reservations:
+                    slave_nodes += r.instances
+                return slave_nodes
+            else:
+                print("%d of %d slaves granted, waiting longer" % (len(active_instance_ids), group['count']))
+    except KeyboardInterrupt:
+        print("Canceling spot instance requests")
+        conn.cancel_spot_instance_requests(my_req_ids)
+        # Log a warning if any of these requests actually launched instances:
+        (master_nodes, slave_nodes) = get_existing_cluster(conn, cluster_name, die_on_error=False)
+        running = len(master_nodes) + len(slave_nodes)
+        if running:
+            print(("WARNING: %d instances are still running" % running), file=stderr)
+        sys.exit(0)
+    except Exception as e:
+        cancel_spot_requests(conn, my_req_ids)
+        raise LaunchError("Spot instance requests failed: {e}".format(e=e))
+
+
+# Request spot slaves spread over several equivalent instance types and subnets until
+# their combined capacity covers opts.slaves units (one unit is an opts.instance_type
+# instance). Requests that a pool can't fill are cancelled and their capacity is asked
+# of the remaining pools instead.
+def request_diversified_spot_slaves(conn, opts, cluster_name, slave_group, target=None):
+    pools = parse_spot_pools(opts)
+    if target is None:
+        target = opts.slaves
+    print("Requesting {n:g} units of spot capacity across {p} instance pools".format(
+        n=target, p=len(pools)))
+
+    req_pools = {}
+    failed_pools = set()
+    next_pool = 0
+    try:
+        while True:
+            reqs = []
+            if req_pools:
+                reqs = conn.get_all_spot_instance_requests(request_ids=list(req_pools))
+            granted = 0.0
+            pending = 0.0
+            cancelled = []
+            for r in reqs:
+                weight = req_pools[r.id][1]
+                if r.state == "active":
+                    granted += weight
+                elif r.state == "open":
+                    if r.status is not None and r.status.code in SPOT_POOL_FAILURE_CODES:
+                        print("Spot pool {t} in {s} failed: {c}".format(
+                            t=req_pools[r.id][0], s=req_pools[r.id][2] or AWS_AZ,
+                            c=r.status.code))
+                        failed_pools.add(req_pools[r.id])
+                        cancelled.append(r.id)
+                    else:
+                        pending += weight
+            if cancelled:
+                conn.cancel_spot_instance_requests(cancelled)
+                for req_id in cancelled:
+                    del req_pools[req_id]
+
+            if granted >= target:
+                break
+            print("{g:g} of {n} units granted, {p:g} pending".format(
+                g=granted, n=target, p=pending))
+
+            # Spread any capacity not yet asked for round-robin over the healthy pools,
+            # and give every pool another chance once all of them have failed
+            healthy = [p for p in pools if p not in failed_pools]
+            if not healthy:
+                failed_pools.clear()
+                healthy = pools
+            counts = {}
+            missing = target - granted - pending
+            while missing > 0:
+                pool = healthy[next_pool % len(healthy)]
+                next_pool += 1
+                counts[pool] = counts.get(pool, 0) + 1
+                missing -= pool[1]
+            for (instance_type, weight, subnet_id), count in counts.items():
+                new_reqs = conn.request_spot_instances(
+                    price=opts.spot_price * weight,
+                    image_id=opts.ami,
+                    placement=None if subnet_id else AWS_AZ,
+                    count=count,
+                    key_name=opts.key_pair,
+                    security_group_ids=[slave_group.id],
+                    instance_type=instance_type,
+                    block_device_map=get_block_device_map(instance_type),
+                    subnet_id=subnet_id,
+                    instance_profile_name=opts.instance_profile_name)
+                for r in new_reqs:
+                    req_pools[r.id] = (instance_type, weight, subnet_id)
+            time.sleep(10)
+    except KeyboardInterrupt:
+        print("Canceling spot instance requests")
+        conn.cancel_spot_instance_requests(list(req_pools))
+        # Log a warning if any of these requests actually launched instances:
+        (master_nodes, slave_nodes) = get_existing_cluster(conn, cluster_name, die_on_error=False)
+        running = len(master_nodes) + len(slave_nodes)
+        if running:
+            print(("WARNING: %d instances are still running" % running), file=stderr)
+        sys.exit(0)
+    except Exception as e:
+        cancel_spot_requests(conn, list(req_pools))
+        raise LaunchError("Spot instance requests failed: {e}".format(e=e))
+
+    # Leave no open requests behind to launch more instances later
+    open_ids = [r.id for r in reqs if r.state == "open"]
+    if open_ids:
+        conn.cancel_spot_instance_requests(open_ids)
+    active_instance_ids = [r.instance_id for r in reqs if r.state == "active"]
+    print("All {n:g} units granted with {i} slaves".format(n=target, i=len(active_instance_ids)))
+    slave_nodes = []
+    for r in conn.get_all_reservations(active_instance_ids):
+        slave_nodes += r.instances
+    return slave_nodes
+
+
 # Launch a cluster of the given name, by setting up its security groups,
 # and then starting new instances in them.
 # Returns a tuple of EC2 reservation objects for the master and slaves
@@ -435,6 +1154,9 @@ def launch_cluster(conn, opts, cluster_name):
         print("ERROR: Must provide a key pair name (-k) to use on instances.", file=stderr)
         sys.exit(1)
 
+    if opts.spot_instance_types and opts.spot_price is None:
+        raise UsageError("--spot-instance-types requires --spot-price.")
+
     authorized_address = opts.authorized_address
     vpc_id = opts.vpc_id
     print("Setting up security groups with authorized address {}, vpc id {}...".format(authorized_address, vpc_id))
@@ -494,93 +1216,64 @@ def launch_cluster(conn, opts, cluster_name):
         print("Could not find AMI " + opts.ami, file=stderr)
         sys.exit(1)
 
-    # Launch slaves
-    if opts.spot_price is not None:
-        # Launch spot instances with the requested price
-        print("Requesting %d slaves as spot instances with price $%.3f" % (opts.slaves, opts.spot_price))
-        my_req_ids = []
-        slave_reqs = conn.request_spot_instances(
-            price=opts.spot_price,
-            image_id=opts.ami,
-            launch_group="launch-group-%s" % cluster_name,
-            placement=AWS_AZ,
-            count=opts.slaves,
-            key_name=opts.key_pair,
-            security_group_ids=[slave_group.id],
-            instance_type=opts.instance_type,
-            subnet_id=opts.subnet_id)
-        my_req_ids += [req.id for req in slave_reqs]
-
-        print("Waiting for spot instances to be granted...")
-        try:
-            while True:
-                time.sleep(10)
-                reqs = conn.get_all_spot_instance_requests()
-                id_to_req = {}
-                for r in reqs:
-                    id_to_req[r.id] = r
-                active_instance_ids = []
-                for i in my_req_ids:
-                    if i in id_to_req and id_to_req[i].state == "active":
-                        active_instance_ids.append(id_to_req[i].instance_id)
-                if len(active_instance_ids) == opts.slaves:
-                    print("All %d slaves granted" % opts.slaves)
-                    reservations = conn.get_all_reservations(active_instance_ids)
-                    slave_nodes = []
-                    for r in reservations:
-                        slave_nodes += r.instances
-                    break
+    master_type = opts.master_instance_type
+    if master_type == "":
+        master_type = opts.instance_type
+    node_groups = get_node_groups(opts)
+    slave_types = [t for group in node_groups for t in group['instance_types']]
+
+    placement_group = None
+    if opts.placement_group:
+        placement_group = get_or_make_placement_group(conn, cluster_name + "-placement").name
+        check_enhanced_networking(image, set([master_type] + slave_types))
+
+    # Launch slaves, remembering which group each was launched in to tag it with
+    slave_groups = []
+    try:
+        if opts.spot_price is not None and opts.spot_instance_types:
+            if placement_group is not None:
+                raise UsageError("--placement-group can't be combined with --spot-instance-types.")
+            if opts.node_groups:
+                raise UsageError("--node-groups can't be combined with --spot-instance-types.")
+            slave_groups.append(
+                (request_diversified_spot_slaves(conn, opts, cluster_name, slave_group),
+                 node_groups[0]))
+        else:
+            for group in node_groups:
+                if group['spot_price'] is not None:
+                    # Launch spot instances with the requested price
+                    nodes = request_spot_slaves(
+                        conn, opts, cluster_name, slave_group, group, placement_group)
                 else:
-                    print("%d of %d slaves granted, waiting longer" % (len(active_instance_ids), opts.slaves))
-        except:
-            print("Canceling spot instance requests")
-            conn.cancel_spot_instance_requests(my_req_ids)
-            # Log a warning if any of these requests actually launched instances:
-            (master_nodes, slave_nodes) = get_existing_cluster(conn, cluster_name, die_on_error=False)
-            running = len(master_nodes) + len(slave_nodes)
-            if running:
-                print(("WARNING: %d instances are still running" % running), file=stderr)
-            sys.exit(0)
-    else:
-        # Launch non-spot instances
-        slave_nodes = []
-        slave_res = image.run(
-            key_name=opts.key_pair,
-            security_group_ids=[slave_group.id],
-            instance_type=opts.instance_type,
-            placement=AWS_AZ,
-            min_count=opts.slaves,
-            max_count=opts.slaves,
-            subnet_id=opts.subnet_id)
-        slave_nodes += slave_res.instances
-        print("Launched {s} slave{plural_s} in {z}, regid = {r}".format(
-            s=opts.slaves,
-            plural_s=('' if opts.slaves == 1 else 's'),
-            z=AWS_AZ,
-            r=slave_res.id))
-
-    # Launch or resume masters
-    if existing_masters:
-        print("Starting master...")
-        for inst in existing_masters:
-            if inst.state not in ["shutting-down", "terminated"]:
-                inst.start()
-        master_nodes = existing_masters
-    else:
-        master_type = opts.master_instance_type
-        if master_type == "":
-            master_type = opts.instance_type
-        master_res = image.run(
-            key_name=opts.key_pair,
-            security_group_ids=[master_group.id],
-            instance_type=master_type,
-            placement=AWS_AZ,
-            min_count=1,
-            max_count=1,
-            subnet_id=opts.subnet_id)
-
-        master_nodes = master_res.instances
-        print("Launched master in %s, regid = %s" % (AWS_AZ, master_res.id))
+                    # Launch non-spot instances
+                    nodes = run_instances(
+                        image, opts, group['count'], group['instance_types'], [slave_group.id],
+                        placement_group)
+                    print("Launched {s} {r} slave{plural_s} in {z}".format(
+                        s=group['count'],
+                        r=group['role'],
+                        plural_s=('' if group['count'] == 1 else 's'),
+                        z=AWS_AZ))
+                slave_groups.append((nodes, group))
+        slave_nodes = [node for (nodes, group) in slave_groups for node in nodes]
+
+        # Launch or resume masters
+        if existing_masters:
+            print("Starting master...")
+            change_instance_states(conn, 'start', existing_masters)
+            master_nodes = existing_masters
+        else:
+            master_nodes = run_instances(
+                image, opts, 1, [master_type], [master_group.id], placement_group)
+            print("Launched master in %s" % AWS_AZ)
+    except LaunchError as e:
+        # Leave nothing running that the failed launch started
+        launched = [node for (nodes, group) in slave_groups for node in nodes]
+        if launched:
+            print("Terminating the {n} slaves already launched...".format(n=len(launched)),
+                  file=stderr)
+            change_instance_states(conn, 'terminate', launched)
+        raise UsageError(str(e))
 
     # This wait time corresponds to SPARK-4983
     print("Waiting for AWS to propagate instance metadata...")
@@ -591,15 +1284,100 @@ def launch_cluster(conn, opts, cluster_name):
             dict(Name='{cn}-master-{iid}'.format(cn=cluster_name, iid=master.id))
         )
 
-    for slave in slave_nodes:
-        slave.add_tags(
-            dict(Name='{cn}-slave-{iid}'.format(cn=cluster_name, iid=slave.id))
-        )
+    for (nodes, group) in slave_groups:
+        tag_slaves(nodes, cluster_name, group)
 
     # Return all the instances
     return master_nodes, slave_nodes
 
 
+# Launch slaves of a node group into an existing cluster in place of the given ones, the
+# same way and with the same security group and placement group as launch_cluster gives
+# them: on demand, as spot instances at the group's price, or as a diversified spot fleet
+# with the capacity of the slaves replaced.
+def launch_slaves(conn, opts, cluster_name, group, replaced):
+    slave_group = get_or_make_group(conn, cluster_name + "-slaves", opts.vpc_id)
+    placement_group = cluster_name + "-placement" if opts.placement_group else None
+    if opts.spot_price is not None and opts.spot_instance_types:
+        weights = dict((t, w) for (t, w, s) in parse_spot_pools(opts))
+        units = sum(weights.get(i.instance_type, 1.0) for i in replaced)
+        slave_nodes = request_diversified_spot_slaves(
+            conn, opts, cluster_name, slave_group, units)
+    elif group['spot_price'] is not None:
+        slave_nodes = request_spot_slaves(
+            conn, opts, cluster_name, slave_group, dict(group, count=len(replaced)),
+            placement_group)
+    else:
+        image = conn.get_all_images(image_ids=[opts.ami or DEFAULT_AMI_ID])[0]
+        slave_nodes = run_instances(
+            image, opts, len(replaced), group['instance_types'], [slave_group.id],
+            placement_group)
+    tag_slaves(slave_nodes, cluster_name, group)
+    return slave_nodes
+
+
+def replace_slaves(opts, cluster_name, stragglers, replacements):
+    """
+    Launch slaves in the node groups of the stragglers that never became ready, and
+    append the ones that become ready within opts.ready_deadline seconds to
+    replacements. The others are terminated. Meant to run in the background while the
+    cluster is set up.
+    """
+    try:
+        # boto connections are not shared between threads
+        conn = connect_to_ec2()
+        print("Launching {n} replacement slaves in the background...".format(n=len(stragglers)))
+        node_groups = get_node_groups(opts)
+        pending = []
+        for group in node_groups:
+            replaced = [i for i in stragglers
+                        if i.tags.get(NODE_GROUP_TAG, node_groups[0]['name']) == group['name']]
+            if replaced:
+                pending += launch_slaves(conn, opts, cluster_name, group, replaced)
+        deadline = time.time() + opts.ready_deadline
+        while pending and time.time() < deadline:
+            time.sleep(10)
+            ready = get_ready_instances(conn, opts, pending)
+            replacements.extend(i for i in pending if i.id in ready)
+            pending = [i for i in pending if i.id not in ready]
+        if pending:
+            print("{n} replacement slaves did not become ready either, terminating them".format(
+                n=len(pending)), file=stderr)
+            change_instance_states(conn, 'terminate', pending)
+    except LaunchError as e:
+        print("Failed to launch replacement slaves: {e}".format(e=e), file=stderr)
+
+
+# Add slaves that became ready after the cluster was set up: give them the cluster's SSH
+# key, redeploy the cluster files listing them, and have the master sync its scripts and
+# hosts entries to every node and start the slave daemons on the new ones.
+def join_slaves(conn, opts, master_nodes, slave_nodes, new_slaves):
+    master = get_dns_name(master_nodes[0], opts.private_ips)
+    dot_ssh_tar = ssh_read(master, opts, ['tar', 'c', '.ssh'])
+    print("Transferring cluster's SSH key to new slaves...")
+    run_on_hosts(
+        [get_dns_name(i, opts.private_ips) for i in new_slaves], opts,
+        lambda host: ssh_write(host, opts, ['tar', 'x'], dot_ssh_tar))
+
+    modules = HADOOP_EC2_MODULES
+    baked_modules = get_baked_modules(conn, master_nodes[0].image_id)
+    print("Deploying files listing the new slaves to master...")
+    deploy_files(
+        conn=conn,
+        root_dir=HADOOP_EC2_DIR + "/" + "deploy.generic",
+        opts=opts,
+        master_nodes=master_nodes,
+        slave_nodes=slave_nodes + new_slaves,
+        modules=modules,
+        baked=all(m in baked_modules for m in modules),
+        scripts_version=get_scripts_version()
+    )
+
+    print("Joining {n} new slaves to the cluster...".format(n=len(new_slaves)))
+    ssh(master, opts, ['bash', 'hadoop-ec2/join.sh'] +
+        [get_cluster_address(i, opts) for i in new_slaves])
+
+
 # Deploy the configuration file templates in a given local directory to
 # a cluster, filling in any template parameters with information about the
 # cluster (e.g. lists of masters and slaves). Files are only deployed to
@@ -607,17 +1385,37 @@ def launch_cluster(conn, opts, cluster_name):
 # script to be run on that instance to copy them to other nodes.
 #
 # root_dir should be an absolute path to the directory with the files we want to deploy.
-def deploy_files(conn, root_dir, opts, master_nodes, slave_nodes, modules):
-    active_master = get_dns_name(master_nodes[0])
+def deploy_files(conn, root_dir, opts, master_nodes, slave_nodes, modules, baked=False,
+                 scripts_version=''):
+    active_master = get_cluster_address(master_nodes[0], opts)
+
+    master_addresses = [get_cluster_address(i, opts) for i in master_nodes]
+    slave_addresses = [get_cluster_address(i, opts) for i in slave_nodes]
+    compute_addresses = [get_cluster_address(i, opts) for i in slave_nodes
+                         if get_node_role(i) == 'compute']
+    # With an IAM instance profile, nodes get S3 credentials from the instance metadata
+    # and our keys never need to leave this machine
+    if opts.instance_profile_name is not None:
+        aws_access_key_id = aws_secret_access_key = ''
+    else:
+        aws_access_key_id = conn.aws_access_key_id or ''
+        aws_secret_access_key = conn.aws_secret_access_key or ''
 
-    master_addresses = [get_dns_name(i) for i in master_nodes]
-    slave_addresses = [get_dns_name(i) for i in slave_nodes]
     template_vars = {"master_list": '\n'.join(master_addresses),
                      "active_master": active_master,
                      "slave_list": '\n'.join(slave_addresses),
+                     "datanode_list": '\n'.join(a for a in slave_addresses
+                                                 if a not in compute_addresses),
+                     "compute_list": '\n'.join(compute_addresses),
                      "modules": '\n'.join(modules),
-                     "aws_access_key_id": conn.aws_access_key_id,
-                     "aws_secret_access_key": conn.aws_secret_access_key}
+                     "baked_image": 'true' if baked else 'false',
+                     "topology_map": get_topology_map(master_nodes + slave_nodes),
+                     "cluster_hosts": get_hosts_entries(master_nodes + slave_nodes),
+                     "cluster_instances": ' '.join(i.id for i in master_nodes + slave_nodes),
+                     "scripts_version": scripts_version,
+                     "expected_blocks": str(opts.expected_blocks),
+                     "aws_access_key_id": aws_access_key_id,
+                     "aws_secret_access_key": aws_secret_access_key}
 
     # Create a temp directory in which we will place all the files to be
     # deployed after we substitute template parameters in them
@@ -644,23 +1442,65 @@ def deploy_files(conn, root_dir, opts, master_nodes, slave_nodes, modules):
         'rsync', '-rv',
         '-e', stringify_command(ssh_command(opts)),
         "%s/" % tmp_dir,
-        "%s@%s:/" % (HADOOP_USER, active_master)
+        "%s@%s:/" % (HADOOP_USER, get_dns_name(master_nodes[0], opts.private_ips))
     ]
     subprocess.check_call(command)
     # Remove the temp directory we created above
     shutil.rmtree(tmp_dir)
 
 
+def get_scripts_version():
+    """
+    Fingerprint the script tree, so that setup can tell whether the copy on the master
+    is already current.
+    """
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(HADOOP_EC2_DIR):
+        dirs[:] = sorted(d for d in dirs if d not in ['.git', '__pycache__'])
+        for name in sorted(f for f in files if not f.endswith('.pyc')):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, HADOOP_EC2_DIR).encode('utf-8'))
+            with open(path, 'rb') as script:
+                digest.update(script.read())
+    return digest.hexdigest()
+
+
 def setup_hadoop_cluster(master, opts):
     ssh(master, opts, "chmod u+x hadoop-ec2/setup.sh")
-    ssh(master, opts, "hadoop-ec2/setup.sh")
+    # Not retried like ssh(): setup.sh only fails when a setup step did, which running
+    # it again won't fix
+    status = subprocess.call(
+        ssh_command(opts) + ['-t', '-t', '%s@%s' % (HADOOP_USER, master), "hadoop-ec2/setup.sh"])
+    if status != 0:
+        raise UsageError("Setup failed on the master with exit code {s}, see the output above."
+                         .format(s=status))
     print("Hadoop standalone cluster started at http://%s:9000" % master)
 
 
+def get_baked_modules(conn, image_id):
+    """
+    Get the modules that were already set up on an AMI registered by bake-ami.
+    """
+    images = conn.get_all_images(image_ids=[image_id])
+    if not images:
+        return []
+    return images[0].tags.get(BAKED_MODULES_TAG, '').split()
+
+
+def get_baked_scripts_version(conn, image_id):
+    """
+    Get the version of the scripts baked into an AMI registered by bake-ami, or None.
+    """
+    images = conn.get_all_images(image_ids=[image_id])
+    if not images:
+        return None
+    return images[0].tags.get(BAKED_SCRIPTS_VERSION_TAG)
+
+
 # Deploy configuration files and run setup scripts on a newly launched
 # or started EC2 cluster.
 def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
-    master = get_dns_name(master_nodes[0])
+    master = get_dns_name(master_nodes[0], opts.private_ips)
     if deploy_ssh_key:
         print("Generating cluster's SSH key on master...")
         key_setup = """
@@ -672,18 +1512,28 @@ def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
         dot_ssh_tar = ssh_read(master, opts, ['tar', 'c', '.ssh'])
         print("Transferring cluster's SSH key to slaves...")
         for slave in slave_nodes:
-            slave_address = get_dns_name(slave)
+            slave_address = get_dns_name(slave, opts.private_ips)
             print(slave_address)
             ssh_write(slave_address, opts, ['tar', 'x'], dot_ssh_tar)
 
-    modules = ['hadoop', 'hive']
-
-    # NOTE: We should clone the repository before running deploy_files to
-    # prevent ec2-variables.sh from being overwritten
-    print("Copying hadoop-ec2 scripts from {p} on master...".format(p=HADOOP_EC2_DIR))
-    scp(host=master,
-        opts=opts,
-        src=HADOOP_EC2_DIR)
+    modules = HADOOP_EC2_MODULES
+
+    baked_modules = get_baked_modules(conn, master_nodes[0].image_id)
+    baked = all(m in baked_modules for m in modules)
+    scripts_version = get_scripts_version()
+    if get_baked_scripts_version(conn, master_nodes[0].image_id) == scripts_version:
+        print("AMI {a} was baked with the current hadoop-ec2 scripts, skipping copy".format(
+            a=master_nodes[0].image_id))
+    elif ssh_read(master, opts, "cat {d}/scripts-version 2>/dev/null || true".format(
+            d=NODE_STATE_DIR)).decode('utf-8').strip() == scripts_version:
+        print("Master already has the current hadoop-ec2 scripts, skipping copy")
+    else:
+        # NOTE: We should clone the repository before running deploy_files to
+        # prevent ec2-variables.sh from being overwritten
+        print("Copying hadoop-ec2 scripts from {p} on master...".format(p=HADOOP_EC2_DIR))
+        scp(host=master,
+            opts=opts,
+            src=HADOOP_EC2_DIR)
 
     print("Deploying files to master...")
     deploy_files(
@@ -692,7 +1542,9 @@ def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
         opts=opts,
         master_nodes=master_nodes,
         slave_nodes=slave_nodes,
-        modules=modules
+        modules=modules,
+        baked=baked,
+        scripts_version=scripts_version
     )
 
     print("Running setup on master...")
@@ -700,12 +1552,537 @@ def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
     print("Done!")
 
 
-def parse_args():
+def tag_image(conn, image_id, tags):
+    """
+    Tag an AMI, retrying with backoff while it is too new for EC2 to find.
+    """
+    from boto.exception import EC2ResponseError
+    deadline = time.time() + IMAGE_TAG_TIMEOUT
+    delay = 1
+    while True:
+        try:
+            conn.create_tags([image_id], tags)
+            return
+        except EC2ResponseError as e:
+            if e.error_code != 'InvalidAMIID.NotFound' or time.time() + delay > deadline:
+                raise
+        time.sleep(delay)
+        delay = min(delay * 2, 10)
+
+
+# Strip per-cluster state from the master of a set-up cluster and register it as an
+# AMI that launch recognizes, so new clusters skip the setup work already done on it.
+def bake_ami(conn, opts, cluster_name, master_nodes):
+    master_node = master_nodes[0]
+    master = get_dns_name(master_node, opts.private_ips)
+    # bake.sh removes the marker of the scripts version on the master with the rest of
+    # its state, so it is kept on the image as a tag instead
+    scripts_version = ssh_read(master, opts, "cat {d}/scripts-version 2>/dev/null || true".format(
+        d=NODE_STATE_DIR)).decode('utf-8').strip()
+    ssh(master, opts, "chmod u+x hadoop-ec2/bake.sh")
+    ssh(master, opts, "hadoop-ec2/bake.sh")
+
+    name = opts.ami_name or "hadoop-ec2-{c}-{t}".format(
+        c=cluster_name, t=datetime.now().strftime('%Y%m%d-%H%M%S'))
+    print("Registering AMI {n} from {i}...".format(n=name, i=master_node.id))
+    image_id = conn.create_image(
+        master_node.id, name,
+        description="hadoop-ec2 node with {m} set up".format(m=', '.join(HADOOP_EC2_MODULES)))
+    tags = {BAKED_MODULES_TAG: ' '.join(HADOOP_EC2_MODULES)}
+    if scripts_version:
+        tags[BAKED_SCRIPTS_VERSION_TAG] = scripts_version
+    tag_image(conn, image_id, tags)
+
+    sys.stdout.write("Waiting for AMI {a} to become available.".format(a=image_id))
+    sys.stdout.flush()
+    while True:
+        time.sleep(15)
+        image = conn.get_all_images(image_ids=[image_id])[0]
+        if image.state == 'available':
+            break
+        if image.state == 'failed':
+            sys.stdout.write("\n")
+            raise UsageError("Registering AMI {a} failed.".format(a=image_id))
+        sys.stdout.write(".")
+        sys.stdout.flush()
+    sys.stdout.write("\n")
+    print("AMI {a} is ready, launch clusters from it with --ami {a}".format(a=image_id))
+
+
+def get_hdfs_usage(master, opts, path):
+    """
+    Get the number of bytes stored under an HDFS path, or 0 if it doesn't exist yet.
+    """
+    try:
+        output = ssh_read(master, opts, "{h}/bin/hdfs dfs -du -s {p} 2>/dev/null".format(
+            h=HADOOP_HOME, p=pipes.quote(path)))
+    except subprocess.CalledProcessError:
+        return 0
+    fields = output.split()
+    return int(fields[0]) if fields else 0
+
+
+# Copy source URIs into an HDFS path on the cluster with distcp, run on the master.
+# The map count and per-map bandwidth are derived from the slaves' vCPUs and network
+# performance. Files already present with the same size and checksum are skipped.
+def stage_data(opts, master_nodes, slave_nodes, sources, dest):
+    # The s3 and s3n connectors are far slower than S3A, which hadoop-conf.py tunes
+    s3a_sources = []
+    for src in sources:
+        if src.startswith(('s3://', 's3n://')):
+            s3a_src = 's3a://' + src.split('://', 1)[1]
+            print("Reading {s} through S3A as {a}".format(s=src, a=s3a_src))
+            src = s3a_src
+        s3a_sources.append(src)
+    sources = s3a_sources
+
+    maps = 0
+    network_mb_per_sec = 0
+    for slave in slave_nodes:
+        spec = get_instance_spec(slave.instance_type)
+        if spec is None:
+            maps += 1
+            network_mb_per_sec += NETWORK_MB_PER_SEC['moderate']
+        else:
+            maps += max(1, spec['vcpus'] // 2)
+            network_mb_per_sec += NETWORK_MB_PER_SEC[spec['network']]
+    maps = max(1, maps)
+    bandwidth = max(1, network_mb_per_sec // maps)
+
+    master = get_dns_name(master_nodes[0], opts.private_ips)
+    dest_bytes_before = get_hdfs_usage(master, opts, dest)
+    print("Staging {s} into {d} with {m} maps at up to {b} MB/s each...".format(
+        s=', '.join(sources), d=dest, m=maps, b=bandwidth))
+    start_time = datetime.now()
+    status = subprocess.call(
+        ssh_command(opts) + ['-t', '-t', '%s@%s' % (HADOOP_USER, master), stringify_command(
+            [HADOOP_HOME + '/bin/hadoop', 'distcp', '-update', '-strategy', 'dynamic',
+             '-m', str(maps), '-bandwidth', str(bandwidth)] + sources + [dest])])
+    elapsed = max(1, (datetime.now() - start_time).seconds)
+    if status != 0:
+        raise UsageError("distcp failed with exit code {s}.".format(s=status))
+
+    # Throughput is measured by how much dest grew, so files distcp -update skipped or
+    # overwrote are not counted
+    staged_mb = (get_hdfs_usage(master, opts, dest) - dest_bytes_before) / (1024.0 * 1024.0)
+    print("Staged {mb:.0f} MB in {t} seconds ({r:.1f} MB/s)".format(
+        mb=staged_mb, t=elapsed, r=staged_mb / elapsed))
+    if dest_bytes_before:
+        print("{d} already held {mb:.0f} MB. Files distcp found up to date, or copied over "
+              "older versions, are left out of the figures above.".format(
+                  d=dest, mb=dest_bytes_before / (1024.0 * 1024.0)))
+
+
+def run_on_hosts(hosts, opts, function):
+    """
+    Call function(host) for every host, at most opts.parallelism at a time, and
+    return the results in the order of hosts.
+    """
+    if not hosts:
+        return []
+    # Workers print where the thread that started them does, which in serve is the
+    # client of its request
+    streams = getattr(SERVED_STREAMS, 'streams', None)
+
+    def run(host):
+        SERVED_STREAMS.streams = streams
+        return function(host)
+
+    pool = ThreadPool(min(opts.parallelism, len(hosts)))
+    try:
+        return pool.map(run, hosts)
+    finally:
+        pool.close()
+
+
+# Stream a compressed tar of each node's logs straight into a local per-host directory,
+# all nodes at once, so the whole collection takes about as long as the slowest node.
+def collect_logs(opts, hosts, dest_dir):
+    find_filters = []
+    if opts.log_since is not None:
+        find_filters += ['-mmin', '-%d' % int(opts.log_since * 60)]
+    if opts.max_log_size is not None:
+        find_filters += ['-size', '-%dk' % int(opts.max_log_size * 1024)]
+    # Live logs grow while they are archived, which makes tar exit 1 with what it did read
+    remote_command = ("cd / && find {d} -type f {f} -print0 2>/dev/null | "
+                      "tar czf - --null -T - --warning=no-file-changed --ignore-failed-read "
+                      "|| [ $? -eq 1 ]").\
+        format(d=' '.join(pipes.quote(d.lstrip('/')) for d in COLLECT_LOG_DIRS),
+               f=' '.join(find_filters))
+
+    def collect(host):
+        host_dir = os.path.join(dest_dir, host)
+        if not os.path.isdir(host_dir):
+            os.makedirs(host_dir)
+        start_time = datetime.now()
+        ssh_proc = subprocess.Popen(
+            ssh_command(opts) + ['%s@%s' % (HADOOP_USER, host), remote_command],
+            stdout=subprocess.PIPE)
+        tar_proc = subprocess.Popen(['tar', 'xzf', '-', '-C', host_dir], stdin=ssh_proc.stdout)
+        ssh_proc.stdout.close()  # so that ssh sees a broken pipe if tar exits early
+        tar_status = tar_proc.wait()
+        ssh_status = ssh_proc.wait()
+        return host, ssh_status or tar_status, (datetime.now() - start_time).seconds
+
+    print("Collecting logs from {n} nodes into {d}...".format(n=len(hosts), d=dest_dir))
+    failed = []
+    for host, status, seconds in run_on_hosts(hosts, opts, collect):
+        if status == 0:
+            print("{h}: done in {t} seconds".format(h=host, t=seconds))
+        else:
+            print("{h}: failed with exit code {s}".format(h=host, s=status), file=stderr)
+            failed.append(host)
+    if failed:
+        raise UsageError("Could not collect logs from {n} node{s}.".format(
+            n=len(failed), s='' if len(failed) == 1 else 's'))
+
+
+def get_role_hosts(opts, master_nodes, slave_nodes):
+    """
+    Get the addresses of the nodes in opts.roles, narrowed down to opts.hosts if given.
+    """
+    instances = {
+        'masters': master_nodes,
+        'slaves': slave_nodes,
+        'all': master_nodes + slave_nodes,
+    }[opts.roles]
+    hosts = [get_dns_name(i, opts.private_ips) for i in instances]
+    if opts.hosts:
+        wanted = opts.hosts.split(',')
+        hosts = [h for h in hosts if h in wanted]
+    return hosts
+
+
+# Run a shell command on many hosts at once, printing their output line by line as it
+# arrives with each line prefixed by its host, then a summary of exit codes and durations.
+def exec_on_hosts(opts, hosts, command):
+    output_lock = threading.Lock()
+
+    def run(host):
+        start_time = datetime.now()
+        proc = subprocess.Popen(
+            ssh_command(opts) + ['%s@%s' % (HADOOP_USER, host), command],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        for line in iter(proc.stdout.readline, b''):
+            with output_lock:
+                sys.stdout.write("[{h}] {l}\n".format(
+                    h=host, l=line.decode('utf-8', 'replace').rstrip('\r\n')))
+                sys.stdout.flush()
+        status = proc.wait()
+        return host, status, (datetime.now() - start_time).total_seconds()
+
+    results = run_on_hosts(hosts, opts, run)
+
+    print("")
+    print("{0:<45} {1:>5} {2:>9}".format("host", "exit", "seconds"))
+    for host, status, seconds in sorted(results, key=lambda r: (r[1] == 0, r[0])):
+        print("{0:<45} {1:>5} {2:>9.1f}".format(host, status, seconds))
+    failed = [host for host, status, seconds in results if status != 0]
+    print("{s} of {n} hosts succeeded".format(s=len(results) - len(failed), n=len(results)))
+    if failed:
+        print("Retry the failed hosts with: --hosts {h}".format(h=','.join(sorted(failed))))
+        sys.exit(1)
+
+
+def format_bytes(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if num_bytes < 1024.0:
+            return "%.1f %s" % (num_bytes, unit)
+        num_bytes /= 1024.0
+    return "%.1f PB" % num_bytes
+
+
+def get_cluster_status(master_nodes, opts):
+    """
+    Collect NameNode, ResourceManager, JobHistory server, DataNode and NodeManager
+    metrics through a single ssh session to the master, which queries them all in
+    parallel with hadoop/cluster-status.py. The ResourceManager web UI only listens on
+    the master's cluster address, so that is the address queried.
+    """
+    master = get_dns_name(master_nodes[0], opts.private_ips)
+    command = ["hadoop-ec2/hadoop/cluster-status.py", get_cluster_address(master_nodes[0], opts)]
+    return json.loads(ssh_read(master, opts, command).decode('utf-8'))
+
+
+def print_cluster_status(status):
+    hdfs = status['hdfs']
+    yarn = status['yarn']
+    history = status['historyserver']
+    nodes = status['nodes']
+
+    print("HDFS: {u} of {c} used ({p:.1f}%), {l} live / {d} dead DataNodes".format(
+        u=format_bytes(hdfs['used_bytes']), c=format_bytes(hdfs['capacity_bytes']),
+        p=100.0 * hdfs['used_bytes'] / max(1, hdfs['capacity_bytes']),
+        l=hdfs['live_datanodes'], d=hdfs['dead_datanodes']))
+    print("      {f} files, {b} blocks, {u} under-replicated, {m} missing, {c} corrupt".format(
+        f=hdfs['files'], b=hdfs['blocks'], u=hdfs['under_replicated_blocks'],
+        m=hdfs['missing_blocks'], c=hdfs['corrupt_blocks']))
+    print("YARN: {r} apps running, {p} pending, {n} containers, "
+          "{mu} of {mt} MB memory, {vu} of {vt} vcores".format(
+              r=yarn['apps_running'], p=yarn['apps_pending'], n=yarn['containers_allocated'],
+              mu=yarn['memory_allocated_mb'], mt=yarn['memory_total_mb'],
+              vu=yarn['vcores_allocated'], vt=yarn['vcores_total']))
+    print("      {a} active / {l} lost / {u} unhealthy NodeManagers".format(
+        a=yarn['active_nodemanagers'], l=yarn['lost_nodemanagers'],
+        u=yarn['unhealthy_nodemanagers']))
+    if history['started_on']:
+        print("JobHistory server: Hadoop {v}, started {s}".format(
+            v=history['hadoop_version'],
+            s=datetime.fromtimestamp(history['started_on'] / 1000).strftime('%Y-%m-%d %H:%M:%S')))
+
+    if nodes:
+        print("")
+        print("{0:<45} {1:>6} {2:>9} {3:>10} {4:>6} {5:>10} {6:>10}".format(
+            "node", "disk%", "blocks", "containers", "mem%", "read", "written"))
+        hottest = sorted(nodes, key=lambda h: nodes[h].get('disk_used_pct', 0),
+                         reverse=True)[:STATUS_HOTTEST_NODES]
+        hottest += [h for h in sorted(nodes, key=lambda h: nodes[h].get('containers', 0),
+                                      reverse=True)[:STATUS_HOTTEST_NODES] if h not in hottest]
+        for host in hottest:
+            node = nodes[host]
+            print("{0:<45} {1:>6.1f} {2:>9} {3:>10} {4:>6.1f} {5:>10} {6:>10}".format(
+                host, node.get('disk_used_pct', 0), node.get('blocks', 0),
+                node.get('containers', 0), node.get('memory_used_pct', 0),
+                format_bytes(node.get('bytes_read', 0)),
+                format_bytes(node.get('bytes_written', 0))))
+        for metric, label in [('disk_used_pct', 'disk usage'), ('containers', 'containers')]:
+            values = [node.get(metric, 0) for node in nodes.values()]
+            mean = float(sum(values)) / len(values)
+            print("Skew in {l}: max {m:.1f} vs mean {a:.1f} across {n} nodes".format(
+                l=label, m=max(values), a=mean, n=len(values)))
+
+    if status['errors']:
+        print("")
+        print("Could not fetch {n} metrics endpoint{s}:".format(
+            n=len(status['errors']), s='' if len(status['errors']) == 1 else 's'))
+        for url, error in sorted(status['errors'].items()):
+            print("  {u}: {e}".format(u=url, e=error))
+
+
+class CachingEC2Connection(object):
+    """
+    An EC2 connection that answers the cluster inventory calls in EC2_CACHED_CALLS from
+    responses at most ttl seconds old. Calls that may change a cluster clear the cache.
+    boto connections are not safe to share between threads, so calls take turns.
+    """
+    def __init__(self, conn, ttl):
+        self.conn = conn
+        self.ttl = ttl
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self.lock:
+                if name.startswith(EC2_MUTATING_CALL_PREFIXES):
+                    self.responses.clear()
+                if name not in EC2_CACHED_CALLS:
+                    return attr(*args, **kwargs)
+                key = (name, repr(args), repr(sorted(kwargs.items())))
+                if key not in self.responses or \
+                        time.time() - self.responses[key][0] > self.ttl:
+                    self.responses[key] = (time.time(), attr(*args, **kwargs))
+                return self.responses[key][1]
+        return call
+
+
+class ServedStream(object):
+    """
+    Stands in for sys.stdout or sys.stderr in serve, so that what each thread prints goes
+    to the client of the request it works on, and everything else to the server's own.
+    """
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def __getattr__(self, attr):
+        streams = getattr(SERVED_STREAMS, 'streams', None)
+        return getattr(streams[self.name] if streams else self.default, attr)
+
+
+def connect_to_server():
+    """
+    Connect to serve if it's running. Returns None if it isn't.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(socket.socket, 'sendmsg') or \
+            not os.path.exists(SERVE_SOCKET):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(SERVE_SOCKET)
+    except socket.error:
+        # Left behind by a server that didn't shut down cleanly
+        client.close()
+        return None
+    return client
+
+
+def forward_to_server(argv):
+    """
+    Run a command in serve, if it's running, handing it this process's stdin, stdout and
+    stderr. Returns the command's exit status, or None if there is no server to run it.
+    """
+    client = connect_to_server()
+    if client is None:
+        return None
+
+    request = json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode('utf-8')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    std_fds = array.array('i', [0, 1, 2])
+    client.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, std_fds)])
+    response = client.makefile('rb').readline()
+    client.close()
+    if not response:
+        print("ERROR: serve stopped before the command finished", file=stderr)
+        return 1
+    return int(response)
+
+
+def run_served_command(conn, serve_opts, argv, cwd):
+    """
+    Run one forwarded command line, given in the client's directory cwd, with the
+    server's EC2 connection and SSH connections, and return its exit status.
+    """
+    try:
+        (opts, action, cluster_name, action_args) = parse_args(argv)
+        if action not in SERVED_ACTIONS:
+            raise UsageError("{a} can't be run through serve".format(a=action))
+        for name in SERVED_PATH_OPTIONS:
+            if getattr(opts, name) is not None:
+                setattr(opts, name, os.path.join(cwd, getattr(opts, name)))
+        opts.ssh_control_path = serve_opts.ssh_control_path
+        opts.control_persist = serve_opts.control_persist
+        run_action(opts, action, cluster_name, action_args, conn)
+        return 0
+    except UsageError as e:
+        print("\nError:\n", e, file=stderr)
+        return 1
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=stderr)
+        return 1
+    except Exception as e:
+        print("ERROR: {e}".format(e=e), file=stderr)
+        return 1
+
+
+def handle_served_request(client, conn, opts):
+    """
+    Run a request from forward_to_server, printing to the client's stdout and stderr,
+    and send back the exit status.
+    """
+    fds = array.array('i')
+    (request, ancdata, flags, address) = client.recvmsg(
+        SERVE_MAX_REQUEST_BYTES, socket.CMSG_LEN(3 * fds.itemsize))
+    for (level, kind, data) in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    # connect_to_server checking whether the server is running
+    if not request and not fds:
+        return
+    if len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        print("Ignoring a request without stdin, stdout and stderr", file=stderr)
+        return
+    request = json.loads(request.decode('utf-8'))
+
+    # Served commands don't read stdin
+    os.close(fds[0])
+    SERVED_STREAMS.streams = {
+        'stdout': os.fdopen(fds[1], 'w', 1),
+        'stderr': os.fdopen(fds[2], 'w', 1),
+    }
+    try:
+        status = run_served_command(conn, opts, request['argv'], request['cwd'])
+    finally:
+        streams = SERVED_STREAMS.streams
+        SERVED_STREAMS.streams = None
+        for stream in streams.values():
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+    client.sendall('{s}\n'.format(s=status).encode('utf-8'))
+
+
+def serve_client(client, conn, opts):
+    try:
+        handle_served_request(client, conn, opts)
+    except Exception as e:
+        print("ERROR: Could not serve a command: {e}".format(e=e), file=stderr)
+    finally:
+        client.close()
+
+
+def serve(conn, opts):
+    """
+    Keep the EC2 connection, cluster inventory and SSH connections to the nodes open, and
+    run the commands that other invocations of this script forward over SERVE_SOCKET,
+    each in its own thread.
+    """
+    global stderr
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(socket.socket, 'recvmsg'):
+        raise UsageError("serve needs Python 3 on a system with Unix sockets")
+    if not os.path.isdir(HADOOP_EC2_STATE_DIR):
+        os.makedirs(HADOOP_EC2_STATE_DIR)
+    running = connect_to_server()
+    if running is not None:
+        running.close()
+        raise UsageError("serve is already running on {s}".format(s=SERVE_SOCKET))
+    if os.path.exists(SERVE_SOCKET):
+        os.remove(SERVE_SOCKET)
+
+    conn = CachingEC2Connection(conn, opts.inventory_ttl)
+    # %C is a hash of the connection, which keeps the socket path short enough
+    opts.ssh_control_path = os.path.join(HADOOP_EC2_STATE_DIR, 'ssh-%C')
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(SERVE_SOCKET)
+    finally:
+        os.umask(old_umask)
+    server.listen(5)
+    print("Serving hadoop-ec2 commands on {s}; press Ctrl-C to stop".format(s=SERVE_SOCKET))
+
+    (server_stdout, server_stderr) = (sys.stdout, sys.stderr)
+    sys.stdout = ServedStream('stdout', server_stdout)
+    sys.stderr = stderr = ServedStream('stderr', server_stderr)
+    # Keep the ssh processes of served commands off the server's terminal
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    try:
+        while True:
+            (client, address) = server.accept()
+            thread = threading.Thread(target=serve_client, args=(client, conn, opts))
+            thread.daemon = True
+            thread.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        (sys.stdout, sys.stderr) = (server_stdout, server_stderr)
+        stderr = server_stderr
+        server.close()
+        os.remove(SERVE_SOCKET)
+
+
+def parse_args(argv=None):
     parser = OptionParser(
         prog="hadoop-ec2",
         version="%prog",
-        usage="%prog [options] <action> <cluster_name>\n\n"
-              + "<action> can be: launch, destroy, login, stop, start, get-master, reboot-slaves")
+        usage="%prog [options] <action> <cluster_name> [<action args>...]\n\n"
+              + "<action> can be: launch, destroy, login, stop, start, get-master, reboot-slaves,\n"
+              + "                 plan, bake-ami, stage <source>... <dest>, status, collect-logs,\n"
+              + "                 exec [--] <command>..., serve")
 
     parser.add_option(
         "-s", "--slaves", type="int", default=1,
@@ -727,9 +2104,35 @@ def parse_args():
         "--spot-price", metavar="PRICE", type="float",
         help="If specified, launch slaves as spot instances with the given " +
              "maximum price (in dollars)")
+    parser.add_option(
+        "--spot-instance-types", default="",
+        help="Comma-separated instance types, each optionally with a :weight, to spread " +
+             "spot slaves over. --slaves then counts capacity in units of --instance-type " +
+             "by vCPU and memory, and --spot-price is the price per unit")
+    parser.add_option(
+        "--spot-subnets", default="",
+        help="Comma-separated VPC subnets to spread --spot-instance-types slaves over " +
+             "(default: --subnet-id)")
+    parser.add_option(
+        "--node-groups", default="",
+        help="Comma-separated groups of slaves to launch instead of --slaves " +
+             "--instance-type ones, each as name=type:count[:role[:spot_price]]. The " +
+             "role is datanode (default) or compute for slaves that run a NodeManager " +
+             "but hold no HDFS blocks, e.g. storage=d2.xlarge:4,cpu=c4.4xlarge:20:compute:0.3")
+    parser.add_option(
+        "--alternate-instance-types", default="",
+        help="Comma-separated instance types to fall back to, in order, when EC2 " +
+             "has no capacity left for --instance-type")
+    parser.add_option(
+        "--placement-group", action="store_true", default=False,
+        help="Launch all instances into a cluster placement group for low-latency, " +
+             "high-bandwidth networking between nodes (default: %default)")
     parser.add_option(
         "-a", "--ami",
         help="Amazon Machine Image ID to use")
+    parser.add_option(
+        "--ami-name", default=None,
+        help="Name of the AMI registered by bake-ami (default: hadoop-ec2-<cluster>-<time>)")
     parser.add_option(
         "--authorized-address", type="string", default="0.0.0.0/0",
         help="Address to authorize on created security groups (default: %default)")
@@ -739,12 +2142,111 @@ def parse_args():
     parser.add_option(
         "--subnet-id", default=None,
         help="VPC subnet to launch instances in")
+    parser.add_option(
+        "--instance-profile-name", default=None,
+        help="IAM instance profile to launch instances with. Nodes then access S3 with " +
+             "its role instead of the AWS keys being copied to them")
+    parser.add_option(
+        "--private-ips", action="store_true", default=False,
+        help="Reach the cluster at its private IP addresses instead of its public DNS " +
+             "names, e.g. when running from inside its VPC (default: %default)")
+    parser.add_option(
+        "--cluster-addressing", type="choice",
+        choices=["private-dns", "private-ip", "public-dns"], default="private-dns",
+        help="What nodes address each other by in the Hadoop configuration: " +
+             "private-dns, private-ip or public-dns (default: %default). Clusters were " +
+             "configured with public-dns before this option existed; pass it to keep that")
+    parser.add_option(
+        "--ready-deadline", type="float", default=None,
+        help="When launching, stop waiting for every slave to become ready after this many " +
+             "seconds and go ahead once --ready-fraction of them are. The rest are " +
+             "terminated and replaced by on-demand slaves in the background, which join " +
+             "the cluster when ready (default: wait for all slaves)")
+    parser.add_option(
+        "--ready-fraction", type="float", default=0.9,
+        help="Fraction of the slaves that must be ready to go ahead after " +
+             "--ready-deadline (default: %default)")
+    parser.add_option(
+        "--expected-blocks", type="int", default=1000000,
+        help="Number of HDFS blocks the cluster is expected to hold, which the NameNode " +
+             "heap is sized for (default: %default)")
+    parser.add_option(
+        "--delete-groups", action="store_true", default=False,
+        help="When destroying a cluster, delete the security groups and placement " +
+             "group that were created (default: %default)")
 
-    (opts, args) = parser.parse_args()
-    if len(args) != 2:
+    parser.add_option(
+        "--parallelism", type="int", default=32,
+        help="Maximum number of nodes to run per-node actions on at once (default: %default)")
+    parser.add_option(
+        "--roles", type="choice", choices=["masters", "slaves", "all"], default="all",
+        help="Nodes to run exec on: masters, slaves or all (default: %default)")
+    parser.add_option(
+        "--hosts", default=None,
+        help="Comma-separated node addresses to limit exec to, e.g. to retry failed hosts")
+    parser.add_option(
+        "--log-dir", default=None,
+        help="Local directory collect-logs writes per-node logs to " +
+             "(default: <cluster>-logs-<time>)")
+    parser.add_option(
+        "--log-since", type="float", metavar="HOURS",
+        help="Only collect logs modified in the last HOURS hours")
+    parser.add_option(
+        "--max-log-size", type="float", metavar="MB",
+        help="Skip log files larger than MB megabytes")
+    parser.add_option(
+        "--json", action="store_true", default=False,
+        help="Print the status action's metrics as JSON (default: %default)")
+    parser.add_option(
+        "--instance-catalog", default=os.path.join(HADOOP_EC2_STATE_DIR, 'instance-catalog.json'),
+        help="JSON file with instance type specs and prices that override or extend the " +
+             "built-in catalog, if it exists (default: %default)")
+    parser.add_option(
+        "--benchmark-file", default=os.path.join(HADOOP_EC2_STATE_DIR, 'benchmarks.json'),
+        help="JSON file with measured per-node scan throughput by instance type, used by " +
+             "plan in place of catalog estimates (default: %default)")
+    parser.add_option(
+        "--data-size", type="float", metavar="GB",
+        help="Size of the dataset to plan a cluster for, in GB")
+    parser.add_option(
+        "--replication", type="int", default=1,
+        help="HDFS replication factor to plan for (default: %default)")
+    parser.add_option(
+        "--scan-throughput", type="float", metavar="MB/S",
+        help="Aggregate scan throughput the planned cluster should reach, in MB/s")
+    parser.add_option(
+        "--time-budget", type="float", metavar="SECONDS",
+        help="Time the planned cluster should take to scan the whole dataset once")
+
+    parser.add_option(
+        "--inventory-ttl", type="int", default=60, metavar="SECONDS",
+        help="In serve, how long to reuse the instances found in a cluster before asking "
+             "EC2 again (default: %default)")
+    parser.add_option(
+        "--control-persist", type="int", default=600, metavar="SECONDS",
+        help="In serve, how long to keep an idle SSH connection to a node open for the next "
+             "command (default: %default)")
+    parser.add_option(
+        "--no-serve", action="store_true", default=False,
+        help="Run the action in this process even if serve is running")
+    parser.set_defaults(ssh_control_path=None)
+
+    (opts, args) = parser.parse_args(argv)
+    # plan works from the local instance catalog alone and needs no cluster or credentials
+    if args == ["plan"]:
+        return opts, "plan", None, []
+    # serve answers commands for every cluster
+    if args == ["serve"]:
+        args.append(None)
+    if len(args) < 2 or (len(args) > 2 and args[0] not in ACTIONS_WITH_ARGS):
         parser.print_help()
         sys.exit(1)
-    (action, cluster_name) = args
+    (action, cluster_name) = args[:2]
+    action_args = args[2:]
+    opts.alternate_instance_types = [t for t in opts.alternate_instance_types.split(',') if t]
+    if not 0 < opts.ready_fraction <= 1:
+        print("ERROR: --ready-fraction must be more than 0 and at most 1", file=sys.stderr)
+        sys.exit(1)
 
     # Boto config check
     # http://boto.cloudhackers.com/en/latest/boto_config_tut.html
@@ -761,12 +2263,21 @@ def parse_args():
                     print("ERROR: The environment variable AWS_SECRET_ACCESS_KEY must be set",
                           file=sys.stderr)
                     sys.exit(1)
-    return opts, action, cluster_name
+    return opts, action, cluster_name, action_args
 
 
 def real_main():
-    (opts, action, cluster_name) = parse_args()
+    (opts, action, cluster_name, action_args) = parse_args()
+
+    if action in SERVED_ACTIONS and not opts.no_serve:
+        status = forward_to_server(sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+
+    run_action(opts, action, cluster_name, action_args)
+
 
+def run_action(opts, action, cluster_name, action_args, conn=None):
     if opts.identity_file is not None:
         if not os.path.exists(opts.identity_file):
             print("ERROR: The identity file '{f}' doesn't exist.".format(f=opts.identity_file),
@@ -780,46 +2291,75 @@ def real_main():
                   file=stderr)
             sys.exit(1)
 
-    if opts.instance_type not in EC2_INSTANCE_TYPES:
+    if opts.instance_catalog is not None and os.path.isfile(opts.instance_catalog):
+        load_instance_catalog(opts.instance_catalog)
+
+    if action == "plan":
+        plan_cluster(opts)
+        return
+
+    if opts.instance_type not in EC2_INSTANCE_CATALOG:
         print("Warning: Unrecognized EC2 instance type for instance-type: {t}".format(
             t=opts.instance_type), file=stderr)
 
     if opts.master_instance_type != "":
-        if opts.master_instance_type not in EC2_INSTANCE_TYPES:
+        if opts.master_instance_type not in EC2_INSTANCE_CATALOG:
             print("Warning: Unrecognized EC2 instance type for master-instance-type: {t}".format(
                 t=opts.master_instance_type), file=stderr)
         # Since we try instance types even if we can't resolve them, we check if they resolve first
         # and, if they do, see if they resolve to the same virtualization type.
-        if opts.instance_type in EC2_INSTANCE_TYPES and \
-                opts.master_instance_type in EC2_INSTANCE_TYPES:
-            if EC2_INSTANCE_TYPES[opts.instance_type] != \
-                    EC2_INSTANCE_TYPES[opts.master_instance_type]:
+        if opts.instance_type in EC2_INSTANCE_CATALOG and \
+                opts.master_instance_type in EC2_INSTANCE_CATALOG:
+            slave_virtualization = EC2_INSTANCE_CATALOG[opts.instance_type]['virtualization']
+            master_virtualization = EC2_INSTANCE_CATALOG[opts.master_instance_type]['virtualization']
+            if slave_virtualization != master_virtualization:
                 print("Error: spark-ec2 currently does not support having a master and slaves "
                       "with different AMI virtualization types.", file=stderr)
                 print("master instance virtualization type: {t}".format(
-                    t=EC2_INSTANCE_TYPES[opts.master_instance_type]), file=stderr)
+                    t=master_virtualization), file=stderr)
                 print("slave instance virtualization type: {t}".format(
-                    t=EC2_INSTANCE_TYPES[opts.instance_type]), file=stderr)
+                    t=slave_virtualization), file=stderr)
                 sys.exit(1)
 
-    try:
-        conn = ec2.connect_to_region(AWS_REGION)
-    except Exception as e:
-        print(e, file=stderr)
-        sys.exit(1)
+    if conn is None:
+        try:
+            conn = connect_to_ec2()
+        except Exception as e:
+            print(e, file=stderr)
+            sys.exit(1)
 
-    if action == "launch":
-        if opts.slaves <= 0:
+    if action == "serve":
+        serve(conn, opts)
+
+    elif action == "launch":
+        if sum(group['count'] for group in get_node_groups(opts)) <= 0:
             print("ERROR: You have to start at least 1 slave", file=sys.stderr)
             sys.exit(1)
         (master_nodes, slave_nodes) = launch_cluster(conn, opts, cluster_name)
-        wait_for_cluster_state(
-            conn=conn,
-            opts=opts,
-            cluster_instances=(master_nodes + slave_nodes),
-            cluster_state='ssh-ready'
-        )
-        setup_cluster(conn, master_nodes, slave_nodes, opts, True)
+        if opts.ready_deadline is None:
+            wait_for_cluster_state(
+                conn=conn,
+                opts=opts,
+                cluster_instances=(master_nodes + slave_nodes),
+                cluster_state='ssh-ready'
+            )
+            setup_cluster(conn, master_nodes, slave_nodes, opts, True)
+        else:
+            (slave_nodes, stragglers) = wait_for_quorum(conn, opts, master_nodes, slave_nodes)
+            replacements = []
+            replacer = None
+            if stragglers:
+                print("Terminating {n} slaves that are not ready...".format(n=len(stragglers)))
+                change_instance_states(conn, 'terminate', stragglers)
+                replacer = threading.Thread(
+                    target=replace_slaves,
+                    args=(opts, cluster_name, stragglers, replacements))
+                replacer.start()
+            setup_cluster(conn, master_nodes, slave_nodes, opts, True)
+            if replacer is not None:
+                replacer.join()
+                if replacements:
+                    join_slaves(conn, opts, master_nodes, slave_nodes, replacements)
 
     elif action == "destroy":
         (master_nodes, slave_nodes) = get_existing_cluster(
@@ -828,18 +2368,14 @@ def real_main():
         if any(master_nodes + slave_nodes):
             print("The following instances will be terminated:")
             for inst in master_nodes + slave_nodes:
-                print("> %s" % get_dns_name(inst))
+                print("> %s" % get_dns_name(inst, opts.private_ips))
             print("ALL DATA ON ALL NODES WILL BE LOST!!")
 
         msg = "Are you sure you want to destroy the cluster {c}? (y/N) ".format(c=cluster_name)
         response = raw_input(msg)
         if response == "y":
-            print("Terminating master...")
-            for inst in master_nodes:
-                inst.terminate()
-            print("Terminating slaves...")
-            for inst in slave_nodes:
-                inst.terminate()
+            print("Terminating {n} instances...".format(n=len(master_nodes + slave_nodes)))
+            change_instance_states(conn, 'terminate', master_nodes + slave_nodes)
 
             # Delete security groups as well
             if opts.delete_groups:
@@ -850,53 +2386,22 @@ def real_main():
                     cluster_instances=(master_nodes + slave_nodes),
                     cluster_state='terminated'
                 )
-                print("Deleting security groups (this will take some time)...")
-                attempt = 1
-                success = False
-                while attempt <= 3:
-                    print("Attempt %d" % attempt)
-                    groups = [g for g in conn.get_all_security_groups() if g.name in group_names]
-                    success = True
-                    # Delete individual rules in all groups before deleting groups to
-                    # remove dependencies between them
-                    for group in groups:
-                        print("Deleting rules in security group " + group.name)
-                        for rule in group.rules:
-                            for grant in rule.grants:
-                                success &= group.revoke(ip_protocol=rule.ip_protocol,
-                                                        from_port=rule.from_port,
-                                                        to_port=rule.to_port,
-                                                        src_group=grant)
-
-                    # Sleep for AWS eventual-consistency to catch up, and for instances
-                    # to terminate
-                    time.sleep(30)  # Yes, it does have to be this long :-(
-                    for group in groups:
-                        try:
-                            # It is needed to use group_id to make it work with VPC
-                            conn.delete_security_group(group_id=group.id)
-                            print("Deleted security group %s" % group.name)
-                        except boto.exception.EC2ResponseError:
-                            success = False
-                            print("Failed to delete security group %s" % group.name)
-
-                    # Unfortunately, group.revoke() returns True even if a rule was not
-                    # deleted, so this needs to be rerun if something fails
-                    if success:
-                        break
-
-                    attempt += 1
-
-                if not success:
-                    print("Failed to delete all security groups after 3 tries.")
+                print("Deleting security groups...")
+                if not delete_security_groups(conn, group_names):
+                    print("Failed to delete all security groups.")
                     print("Try re-running in a few minutes.")
 
+                placement_group_name = cluster_name + "-placement"
+                if any(g.name == placement_group_name for g in conn.get_all_placement_groups()):
+                    conn.delete_placement_group(placement_group_name)
+                    print("Deleted placement group %s" % placement_group_name)
+
     elif action == "login":
         (master_nodes, slave_nodes) = get_existing_cluster(conn, cluster_name)
-        if not master_nodes[0].public_dns_name:
+        if not master_nodes[0].public_dns_name and not opts.private_ips:
             print("Master has no public DNS name.  Maybe you meant to specify --private-ips?")
         else:
-            master = get_dns_name(master_nodes[0])
+            master = get_dns_name(master_nodes[0], opts.private_ips)
             print("Logging into master " + master + "...")
             subprocess.check_call(
                 ssh_command(opts) + ['-t', '-t', "%s@%s" % (HADOOP_USER, master)])
@@ -909,18 +2414,51 @@ def real_main():
         if response == "y":
             (master_nodes, slave_nodes) = get_existing_cluster(
                 conn, cluster_name, die_on_error=False)
-            print("Rebooting slaves...")
-            for inst in slave_nodes:
-                if inst.state not in ["shutting-down", "terminated"]:
-                    print("Rebooting " + inst.id)
-                    inst.reboot()
+            rebooted = change_instance_states(conn, 'reboot', slave_nodes)
+            print("Rebooted {n} slaves".format(n=len(rebooted)))
+
+    elif action == "bake-ami":
+        (master_nodes, slave_nodes) = get_existing_cluster(conn, cluster_name)
+        response = raw_input(
+            "Baking stops Hadoop on the master of " + cluster_name + ", deletes its\n" +
+            "HDFS metadata and SSH keys and reboots it. Only bake from a cluster you no\n" +
+            "longer need. Bake AMI from " + cluster_name + " (y/N): ")
+        if response == "y":
+            bake_ami(conn, opts, cluster_name, master_nodes)
+
+    elif action == "stage":
+        if len(action_args) < 2:
+            raise UsageError("Usage: stage <cluster_name> <source>... <dest>")
+        (master_nodes, slave_nodes) = get_existing_cluster(conn, cluster_name)
+        stage_data(opts, master_nodes, slave_nodes, action_args[:-1], action_args[-1])
+
+    elif action == "status":
+        (master_nodes, slave_nodes) = get_existing_cluster(conn, cluster_name, quiet=opts.json)
+        status = get_cluster_status(master_nodes, opts)
+        if opts.json:
+            print(json.dumps(status, indent=2, sort_keys=True))
+        else:
+            print_cluster_status(status)
+
+    elif action == "collect-logs":
+        (master_nodes, slave_nodes) = get_existing_cluster(conn, cluster_name)
+        dest_dir = opts.log_dir or "{c}-logs-{t}".format(
+            c=cluster_name, t=datetime.now().strftime('%Y%m%d-%H%M%S'))
+        hosts = [get_dns_name(i, opts.private_ips) for i in master_nodes + slave_nodes]
+        collect_logs(opts, hosts, dest_dir)
+
+    elif action == "exec":
+        if not action_args:
+            raise UsageError("Usage: exec <cluster_name> [--] <command>...")
+        (master_nodes, slave_nodes) = get_existing_cluster(conn, cluster_name)
+        exec_on_hosts(opts, get_role_hosts(opts, master_nodes, slave_nodes), ' '.join(action_args))
 
     elif action == "get-master":
         (master_nodes, slave_nodes) = get_existing_cluster(conn, cluster_name)
-        if not master_nodes[0].public_dns_name:
+        if not master_nodes[0].public_dns_name and not opts.private_ips:
             print("Master has no public DNS name.  Maybe you meant to specify --private-ips?")
         else:
-            print(get_dns_name(master_nodes[0]))
+            print(get_dns_name(master_nodes[0], opts.private_ips))
 
     elif action == "stop":
         response = raw_input(
@@ -933,28 +2471,21 @@ def real_main():
         if response == "y":
             (master_nodes, slave_nodes) = get_existing_cluster(
                 conn, cluster_name, die_on_error=False)
+            # Spot instances cannot be stopped, only terminated
+            spot_slaves = [i for i in slave_nodes if i.spot_instance_request_id]
             print("Stopping master...")
-            for inst in master_nodes:
-                if inst.state not in ["shutting-down", "terminated"]:
-                    inst.stop()
+            change_instance_states(conn, 'stop', master_nodes)
             print("Stopping slaves...")
-            for inst in slave_nodes:
-                if inst.state not in ["shutting-down", "terminated"]:
-                    if inst.spot_instance_request_id:
-                        inst.terminate()
-                    else:
-                        inst.stop()
+            change_instance_states(
+                conn, 'stop', [i for i in slave_nodes if i not in spot_slaves])
+            change_instance_states(conn, 'terminate', spot_slaves)
 
     elif action == "start":
         (master_nodes, slave_nodes) = get_existing_cluster(conn, cluster_name)
         print("Starting slaves...")
-        for inst in slave_nodes:
-            if inst.state not in ["shutting-down", "terminated"]:
-                inst.start()
+        change_instance_states(conn, 'start', slave_nodes)
         print("Starting master...")
-        for inst in master_nodes:
-            if inst.state not in ["shutting-down", "terminated"]:
-                inst.start()
+        change_instance_states(conn, 'start', master_nodes)
         wait_for_cluster_state(
             conn=conn,
             opts=opts,
@@ -0,0 +1,16 @@
+#!/bin/bash
+
+HADOOP_HOME=/usr/local/hadoop
+
+echo "Stopping Hadoop daemons on `hostname`..."
+${HADOOP_HOME}/sbin/mr-jobhistory-daemon.sh stop historyserver
+${HADOOP_HOME}/sbin/yarn-daemon.sh stop resourcemanager
+${HADOOP_HOME}/sbin/yarn-daemon.sh stop nodemanager
+${HADOOP_HOME}/sbin/hadoop-daemon.sh stop namenode
+${HADOOP_HOME}/sbin/hadoop-daemon.sh stop secondarynamenode
+${HADOOP_HOME}/sbin/hadoop-daemon.sh stop datanode
+
+# The HDFS name and data dirs and the YARN/MR scratch dirs all belong to this cluster
+rm -rf ${HADOOP_HOME}/data ${HADOOP_HOME}/logs/*
+rm -f ${HADOOP_HOME}/etc/hadoop/slaves ${HADOOP_HOME}/etc/hadoop/yarn-slaves
+sed -i '/^export HDFS_URL=/d' ~/.bash_profile
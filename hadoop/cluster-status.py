@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+import json
+import sys
+import threading
+from optparse import OptionParser
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+NAMENODE_HTTP_PORT = 50070
+DATANODE_HTTP_PORT = 50075
+RESOURCEMANAGER_HTTP_PORT = 8088
+NODEMANAGER_HTTP_PORT = 8042
+HISTORYSERVER_HTTP_PORT = 19888
+
+FETCH_TIMEOUT = 10
+MAX_PARALLEL_FETCHES = 64
+
+
+def fetch_all(urls):
+    """
+    Fetch JSON from all the URLs at once. Returns a dict from URL to the decoded
+    response, and a dict from URL to the error for those that failed.
+    """
+    results = {}
+    errors = {}
+    slots = threading.BoundedSemaphore(MAX_PARALLEL_FETCHES)
+
+    def fetch(url):
+        with slots:
+            try:
+                response = urlopen(url, timeout=FETCH_TIMEOUT)
+                results[url] = json.loads(response.read().decode('utf-8'))
+            except Exception as e:
+                errors[url] = str(e)
+
+    threads = [threading.Thread(target=fetch, args=(url,)) for url in set(urls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def jmx_url(host, port, query):
+    return 'http://{}:{}/jmx?qry={}'.format(host, port, query)
+
+
+def jmx_beans(response):
+    """
+    Merge the attributes of all the beans in a JMX response into one dict.
+    """
+    merged = {}
+    for bean in (response or {}).get('beans', []):
+        merged.update(bean)
+    return merged
+
+
+def percent(part, whole):
+    return round(100.0 * part / whole, 1) if whole else 0.0
+
+
+def get_status(master):
+    namenode_url = jmx_url(master, NAMENODE_HTTP_PORT, 'Hadoop:service=NameNode,name=FSNamesystem*')
+    namenode_info_url = jmx_url(master, NAMENODE_HTTP_PORT, 'Hadoop:service=NameNode,name=NameNodeInfo')
+    rm_url = 'http://{}:{}/ws/v1/cluster'.format(master, RESOURCEMANAGER_HTTP_PORT)
+    rm_metrics_url = rm_url + '/metrics'
+    rm_nodes_url = rm_url + '/nodes'
+    history_url = 'http://{}:{}/ws/v1/history/info'.format(master, HISTORYSERVER_HTTP_PORT)
+
+    # The master daemons tell us which DataNodes and NodeManagers to ask next
+    results, errors = fetch_all(
+        [namenode_url, namenode_info_url, rm_metrics_url, rm_nodes_url, history_url])
+
+    namenode = jmx_beans(results.get(namenode_url))
+    live_nodes = json.loads(jmx_beans(results.get(namenode_info_url)).get('LiveNodes') or '{}')
+    rm_metrics = (results.get(rm_metrics_url) or {}).get('clusterMetrics', {})
+    rm_nodes = ((results.get(rm_nodes_url) or {}).get('nodes') or {}).get('node', [])
+    history = (results.get(history_url) or {}).get('historyInfo', {})
+
+    nodes = {}
+    node_urls = {}
+    for name, info in live_nodes.items():
+        host = name.split(':')[0]
+        nodes.setdefault(host, {}).update({
+            'hdfs_used_bytes': info.get('usedSpace', 0),
+            'disk_used_pct': percent(info.get('usedSpace', 0) + info.get('nonDfsUsedSpace', 0),
+                                     info.get('capacity', 0)),
+            'blocks': info.get('numBlocks', 0),
+        })
+        node_urls[jmx_url(host, DATANODE_HTTP_PORT,
+                          'Hadoop:service=DataNode,name=DataNodeActivity*')] = ('datanode', host)
+    for info in rm_nodes:
+        host = info.get('nodeHostName')
+        used_mb = info.get('usedMemoryMB', 0)
+        nodes.setdefault(host, {}).update({
+            'health': info.get('state'),
+            'containers': info.get('numContainers', 0),
+            'memory_used_pct': percent(used_mb, used_mb + info.get('availMemoryMB', 0)),
+        })
+        node_urls[jmx_url(host, NODEMANAGER_HTTP_PORT,
+                          'Hadoop:service=NodeManager,name=NodeManagerMetrics')] = ('nodemanager', host)
+
+    node_results, node_errors = fetch_all(list(node_urls))
+    errors.update(node_errors)
+    for url, (daemon, host) in node_urls.items():
+        beans = jmx_beans(node_results.get(url))
+        if daemon == 'datanode':
+            nodes[host]['bytes_read'] = beans.get('BytesRead', 0)
+            nodes[host]['bytes_written'] = beans.get('BytesWritten', 0)
+        else:
+            nodes[host]['containers_failed'] = beans.get('ContainersFailed', 0)
+
+    return {
+        'hdfs': {
+            'capacity_bytes': namenode.get('CapacityTotal', 0),
+            'used_bytes': namenode.get('CapacityUsed', 0),
+            'remaining_bytes': namenode.get('CapacityRemaining', 0),
+            'live_datanodes': namenode.get('NumLiveDataNodes', 0),
+            'dead_datanodes': namenode.get('NumDeadDataNodes', 0),
+            'files': namenode.get('FilesTotal', 0),
+            'blocks': namenode.get('BlocksTotal', 0),
+            'under_replicated_blocks': namenode.get('UnderReplicatedBlocks', 0),
+            'missing_blocks': namenode.get('MissingBlocks', 0),
+            'corrupt_blocks': namenode.get('CorruptBlocks', 0),
+        },
+        'yarn': {
+            'apps_running': rm_metrics.get('appsRunning', 0),
+            'apps_pending': rm_metrics.get('appsPending', 0),
+            'containers_allocated': rm_metrics.get('containersAllocated', 0),
+            'memory_total_mb': rm_metrics.get('totalMB', 0),
+            'memory_allocated_mb': rm_metrics.get('allocatedMB', 0),
+            'vcores_total': rm_metrics.get('totalVirtualCores', 0),
+            'vcores_allocated': rm_metrics.get('allocatedVirtualCores', 0),
+            'active_nodemanagers': rm_metrics.get('activeNodes', 0),
+            'lost_nodemanagers': rm_metrics.get('lostNodes', 0),
+            'unhealthy_nodemanagers': rm_metrics.get('unhealthyNodes', 0),
+        },
+        'historyserver': {
+            'started_on': history.get('startedOn'),
+            'hadoop_version': history.get('hadoopVersion'),
+        },
+        'nodes': nodes,
+        'errors': errors,
+    }
+
+
+def main():
+    parser = OptionParser(
+        prog="cluster-status",
+        usage="%prog [<master>]\n\n"
+              "Print NameNode, ResourceManager, JobHistory server, DataNode and NodeManager\n"
+              "metrics as one JSON document.")
+
+    (opts, args) = parser.parse_args()
+    if len(args) > 1:
+        parser.print_help()
+        sys.exit(1)
+
+    json.dump(get_status(args[0] if args else 'localhost'), sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
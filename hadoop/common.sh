@@ -0,0 +1,33 @@
+#!/bin/bash
+
+# Sourced by configure.sh and join.sh, so that the whole cluster and the slaves joined
+# to it later are configured the same way.
+
+HADOOP_HOME=/usr/local/hadoop
+
+# Without deployed keys, S3 is reached with the instances' IAM role
+AWS_KEYS=""
+if [[ -n "${AWS_ACCESS_KEY_ID}" ]]; then
+  AWS_KEYS="${AWS_ACCESS_KEY_ID} ${AWS_SECRET_ACCESS_KEY}"
+fi
+
+# The map output codec configure.sh picked for the cluster
+MAP_OUTPUT_CODEC_FILE=${HOME}/.hadoop-ec2-state/map-output-codec
+
+# DataNodes are started on the slaves file, NodeManagers on yarn-slaves, which also
+# lists the compute-only slaves
+write_slaves_files () {
+  echo ${DATANODES} > ${HADOOP_HOME}/etc/hadoop/slaves
+  echo ${SLAVES} > ${HADOOP_HOME}/etc/hadoop/yarn-slaves
+}
+
+# usage: get_node_type node
+# Prints the hadoop-conf.py node type of a slave: nodemanager for compute-only slaves,
+# datanode for the others
+get_node_type () {
+  if echo "${COMPUTE_NODES}" | grep -qxF "$1"; then
+    echo "nodemanager"
+  else
+    echo "datanode"
+  fi
+}
@@ -0,0 +1,63 @@
+#!/bin/bash
+
+# Write the Hadoop configuration on every node of the cluster
+
+source ${HOME}/hadoop-ec2/hadoop/common.sh
+
+# Set hdfs url to make it easier
+HDFS_URL="hdfs://${ACTIVE_MASTER}:9000"
+sed -i '/^export HDFS_URL=/d' ~/.bash_profile
+echo "export HDFS_URL=${HDFS_URL}" >> ~/.bash_profile
+
+pushd ${HADOOP_HOME} > /dev/null
+
+# Keep each node's configuration output to summarize native library checks afterwards
+CONF_LOG_DIR=`mktemp -d`
+
+# Jobs take the map output codec from the configuration of the node they are submitted
+# from, and every node's tasks then use it, so only a codec all nodes load will do
+echo "Checking native libraries on every node..."
+${HOME}/hadoop-ec2/hadoop/hadoop-conf.py --check-native > ${CONF_LOG_DIR}/${ACTIVE_MASTER}
+for node in ${SLAVES} ${OTHER_MASTERS}; do
+  ssh ${SSH_OPTS} ubuntu@${node} "source ~/.bash_profile; hadoop-ec2/hadoop/hadoop-conf.py --check-native" > ${CONF_LOG_DIR}/${node} 2>&1 & sleep 0.3
+done
+wait
+MAP_OUTPUT_CODEC=none
+for codec in snappy lz4; do
+  if [[ -z `grep -L "^Native libraries:.* ${codec}=true" ${CONF_LOG_DIR}/*` ]]; then
+    MAP_OUTPUT_CODEC=${codec}
+    break
+  fi
+done
+echo "Compressing map output with: ${MAP_OUTPUT_CODEC}"
+# New slaves joined later are configured the same way
+echo ${MAP_OUTPUT_CODEC} > ${MAP_OUTPUT_CODEC_FILE}
+
+${HOME}/hadoop-ec2/hadoop/hadoop-conf.py --expected-blocks "${EXPECTED_BLOCKS}" --map-output-codec ${MAP_OUTPUT_CODEC} "${ACTIVE_MASTER}" "namenode_datanode" ${AWS_KEYS} | tee ${CONF_LOG_DIR}/${ACTIVE_MASTER}
+write_slaves_files
+
+for node in ${SLAVES} ${OTHER_MASTERS}; do
+  echo "Configuring slave node: ${node}"
+  node_type=`get_node_type ${node}`
+  ssh -t -t ${SSH_OPTS} ubuntu@${node} "source ~/.bash_profile; hadoop-ec2/hadoop/hadoop-conf.py --map-output-codec ${MAP_OUTPUT_CODEC}" "${ACTIVE_MASTER}" "${node_type}" ${AWS_KEYS} > ${CONF_LOG_DIR}/${node} 2>&1 & sleep 0.3
+done
+wait
+
+echo "Native library summary:"
+CONF_FAILED=false
+for node in ${ACTIVE_MASTER} ${SLAVES} ${OTHER_MASTERS}; do
+  native_status=`grep -h "^Native libraries:" ${CONF_LOG_DIR}/${node} | tr -d '\r' | cut -d: -f2-`
+  echo "  ${node}:${native_status:- configuration failed, see below}"
+  if [[ -z "${native_status}" ]]; then
+    sed 's/^/    /' ${CONF_LOG_DIR}/${node}
+    CONF_FAILED=true
+  fi
+done
+rm -rf ${CONF_LOG_DIR}
+
+popd > /dev/null
+
+# Nothing that needs the configuration should start on a node without it
+if [[ "${CONF_FAILED}" == "true" ]]; then
+  exit 1
+fi
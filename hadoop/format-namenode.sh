@@ -0,0 +1,11 @@
+#!/bin/bash
+
+HADOOP_HOME=/usr/local/hadoop
+NAMENODE_PATH="${HADOOP_HOME}/data/hdfs/namenode"
+
+if [[ -f "${NAMENODE_PATH}/current/VERSION" ]] && ls ${NAMENODE_PATH}/current/fsimage_* > /dev/null 2>&1; then
+  echo "Hadoop namenode appears to be formatted: skipping"
+else
+  echo "Formatting HDFS namenode..."
+  ${HADOOP_HOME}/bin/hdfs namenode -format -nonInteractive
+fi
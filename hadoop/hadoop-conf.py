@@ -1,5 +1,11 @@
 #!/usr/bin/env python
 
+import getpass
+import hashlib
+import math
+import multiprocessing
+import re
+import subprocess
 import sys
 import xml.etree.ElementTree as ETree
 from optparse import OptionParser
@@ -8,6 +14,11 @@ import os
 
 HADOOP_HOME = os.getenv('HADOOP_HOME', '/usr/local/hadoop')
 HADOOP_CONF_DIR = os.getenv('HADOOP_CONF_DIR', os.path.join(HADOOP_HOME, 'etc/hadoop'))
+HADOOP_EC2_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Rack mapping written by the launcher, and the script that serves it to HDFS and YARN
+TOPOLOGY_DATA = os.path.join(HADOOP_EC2_DIR, 'topology.data')
+TOPOLOGY_SCRIPT = os.path.join(HADOOP_EC2_DIR, 'hadoop', 'topology.sh')
 
 YARN_MINIMUM_ALLOCATION_MB = '4096'
 YARN_MAXIMUM_ALLOCATION_MB = '32768'
@@ -15,15 +26,287 @@ YARN_MINIMUM_CORES = '1'
 YARN_MAXIMUM_CORES = '64'
 YARN_SHUFFLE_CLASS = 'org.apache.hadoop.mapred.ShuffleHandler'
 
+# Memory left to the OS rather than offered to YARN containers. The heaps of the Hadoop
+# daemons on the node are held back as well, and what remains must fit at least one
+# container of the minimum allocation.
+YARN_RESERVED_MEMORY_FRACTION = 0.1
+YARN_MIN_RESERVED_MEMORY_MB = 1024
+
+# Daemon heaps in MB. The NameNode keeps the whole namespace in memory, about 1 GB per
+# million blocks, and the SecondaryNameNode loads a copy of it to checkpoint, so both are
+# sized for the expected block count, up to a fraction of the node's memory between them.
+DAEMON_HEAP_MB = 1024
+NAMENODE_MIN_HEAP_MB = 1024
+NAMENODE_HEAP_MB_PER_MILLION_BLOCKS = 1024
+NAMENODE_MAX_MEMORY_FRACTION = 0.5
+DEFAULT_EXPECTED_BLOCKS = 1000000
+
+# The env script and variable that pass JVM options to each daemon
+DAEMON_ENV = {
+    'namenode': ('hadoop-env.sh', 'HADOOP_NAMENODE_OPTS'),
+    'secondarynamenode': ('hadoop-env.sh', 'HADOOP_SECONDARYNAMENODE_OPTS'),
+    'datanode': ('hadoop-env.sh', 'HADOOP_DATANODE_OPTS'),
+    'resourcemanager': ('yarn-env.sh', 'YARN_RESOURCEMANAGER_OPTS'),
+    'nodemanager': ('yarn-env.sh', 'YARN_NODEMANAGER_OPTS'),
+    'historyserver': ('mapred-env.sh', 'HADOOP_JOB_HISTORYSERVER_OPTS'),
+}
+ENV_BLOCK_BEGIN = '# BEGIN hadoop-ec2 daemon tuning'
+ENV_BLOCK_END = '# END hadoop-ec2 daemon tuning'
+GC_LOG_FILES = 5
+GC_LOG_FILE_SIZE = '20M'
+
+# S3A connector tuning: thread pools and connections scale with the node's vCPUs, and
+# nodes with this much memory buffer uploads in memory instead of on local disk
+S3A_THREADS_PER_VCORE = 2
+S3A_CONNECTIONS_PER_VCORE = 4
+S3A_MIN_THREADS = 16
+S3A_MEMORY_BUFFER_MIN_MB = 65536
+S3A_MULTIPART_SIZE = str(128 * 1024 * 1024)
+S3A_READAHEAD_RANGE = str(256 * 1024)
+S3A_INSTANCE_PROFILE_PROVIDER = 'com.amazonaws.auth.InstanceProfileCredentialsProvider'
+
+# Formats and mounts the instance store disks, and prints a directory on each for HDFS
+MOUNT_DISKS_SCRIPT = os.path.join(HADOOP_EC2_DIR, 'hadoop', 'mount-disks.sh')
+
+# Unix domain socket the DataNode passes block file descriptors to local readers over
+DFS_DOMAIN_SOCKET_DIR = '/var/lib/hadoop-hdfs'
+DFS_DOMAIN_SOCKET_PATH = os.path.join(DFS_DOMAIN_SOCKET_DIR, 'dn_socket')
+
+# Fingerprint of the inputs of the last run and the summary line it printed, so that a
+# restarted node whose inputs haven't changed isn't reconfigured. setup.sh keeps its
+# markers in the same place, outside the rsynced tree.
+CONF_STATE_FILE = os.path.join(os.path.expanduser('~'), '.hadoop-ec2-state', 'hadoop-conf')
+
 MAPREDUCE_MAP_MEMORY = '4096'
 MAPREDUCE_REDUCE_MEMORY = '4096'
 MAPREDUCE_JAVA_OPTS = '-Xmx1536m'
 
+# Codecs intermediate map output can be compressed with. Jobs take the codec from the
+# configuration of the node they are submitted from, so configure.sh picks one that
+# every node's native libraries can load.
+MAP_OUTPUT_CODECS = {
+    'snappy': 'org.apache.hadoop.io.compress.SnappyCodec',
+    'lz4': 'org.apache.hadoop.io.compress.Lz4Codec',
+}
+
+
+def get_node_resources():
+    """
+    Get the number of vCPUs and the memory in MB of this node, so that YARN offers what
+    the instance actually has, whichever type it was launched as.
+    """
+    mem_mb = 0
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemTotal:'):
+                mem_mb = int(line.split()[1]) // 1024
+    return multiprocessing.cpu_count(), mem_mb
+
+
+def check_native():
+    """
+    Run hadoop checknative and return whether each native library loaded on this node,
+    e.g. {'hadoop': True, 'zlib': True, 'snappy': False, ...}.
+    """
+    try:
+        checknative = subprocess.Popen(
+            [os.path.join(HADOOP_HOME, 'bin/hadoop'), 'checknative', '-a'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    except OSError:
+        return {}
+    output = checknative.communicate()[0].decode('utf-8', 'replace')
+    libs = {}
+    for line in output.splitlines():
+        match = re.match(r'^\s*(\w+):\s+(true|false)\b', line)
+        if match:
+            libs[match.group(1)] = match.group(2) == 'true'
+    return libs
+
+
+def format_native_libs(native_libs):
+    libs = ' '.join('{}={}'.format(lib, str(ok).lower()) for lib, ok in sorted(native_libs.items()))
+    return libs or 'checknative failed'
+
+
+def get_conf_fingerprint(args, vcores, mem_mb):
+    """
+    Fingerprint everything the configuration is generated from: the arguments and
+    options, this node's resources, this script itself, the disk mounting script and
+    the rack topology, if any.
+    """
+    digest = hashlib.sha1()
+    for path in [os.path.realpath(__file__), MOUNT_DISKS_SCRIPT, TOPOLOGY_DATA]:
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        else:
+            digest.update(('no ' + path).encode('utf-8'))
+    digest.update(' '.join(args + [str(vcores), str(mem_mb)]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_conf_state():
+    """
+    Get the fingerprint and summary line of the last run, or (None, None).
+    """
+    try:
+        with open(CONF_STATE_FILE) as state:
+            lines = state.read().splitlines()
+    except IOError:
+        return None, None
+    return (lines + [None, None])[:2]
+
+
+def write_conf_state(fingerprint, summary):
+    state_dir = os.path.dirname(CONF_STATE_FILE)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    with open(CONF_STATE_FILE, 'w') as state:
+        state.write(fingerprint + '\n' + summary + '\n')
+
+
+def get_java_version():
+    """
+    Get the major version of the JVM the daemons run on, e.g. 8, or 8 if it can't be told.
+    """
+    java = os.path.join(os.getenv('JAVA_HOME', ''), 'bin/java') if os.getenv('JAVA_HOME') else 'java'
+    try:
+        version = subprocess.Popen([java, '-version'],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+    except OSError:
+        return 8
+    output = version.communicate()[0].decode('utf-8', 'replace')
+    match = re.search(r'version "(\d+)(?:\.(\d+))?', output)
+    if not match:
+        return 8
+    major = int(match.group(1))
+    # Up to Java 8 versions read 1.<major>
+    return int(match.group(2) or 0) if major == 1 else major
+
+
+def get_daemon_heaps(node_type, mem_mb, expected_blocks):
+    """
+    Get the heap in MB of each Hadoop daemon a node of node_type runs.
+    """
+    heaps = {'nodemanager': DAEMON_HEAP_MB}
+    if 'datanode' in node_type:
+        heaps['datanode'] = DAEMON_HEAP_MB
+    if 'namenode' in node_type:
+        namenode_heap_mb = max(NAMENODE_MIN_HEAP_MB, int(math.ceil(
+            expected_blocks / 1000000.0 * NAMENODE_HEAP_MB_PER_MILLION_BLOCKS)))
+        max_heap_mb = max(NAMENODE_MIN_HEAP_MB, int(mem_mb * NAMENODE_MAX_MEMORY_FRACTION / 2))
+        if namenode_heap_mb > max_heap_mb:
+            print("Warning: {b} blocks need a {n} MB NameNode heap, but this node can only "
+                  "give it {m} MB. Use a master with more memory.".format(
+                      b=expected_blocks, n=namenode_heap_mb, m=max_heap_mb))
+            namenode_heap_mb = max_heap_mb
+        heaps['namenode'] = heaps['secondarynamenode'] = namenode_heap_mb
+        heaps['resourcemanager'] = heaps['historyserver'] = DAEMON_HEAP_MB
+    return heaps
+
+
+def get_yarn_memory_mb(mem_mb, heaps):
+    """
+    Get the memory in MB a node offers YARN containers once the OS and the daemon heaps
+    have theirs. When that is less than one container, the NameNode and SecondaryNameNode
+    heaps in heaps are cut, down to their minimum, to make room. Returns None if there is
+    still no room.
+    """
+    min_container_mb = int(YARN_MINIMUM_ALLOCATION_MB)
+    yarn_mem_mb = mem_mb - max(YARN_MIN_RESERVED_MEMORY_MB, int(mem_mb * YARN_RESERVED_MEMORY_FRACTION))
+    yarn_mem_mb -= sum(heaps.values())
+    if yarn_mem_mb < min_container_mb and 'namenode' in heaps:
+        cut_mb = min(heaps['namenode'] - NAMENODE_MIN_HEAP_MB,
+                     int(math.ceil((min_container_mb - yarn_mem_mb) / 2.0)))
+        if cut_mb > 0:
+            print("Warning: cutting the NameNode and SecondaryNameNode heaps to {h} MB to leave "
+                  "room for a {c} MB YARN container.".format(
+                      h=heaps['namenode'] - cut_mb, c=min_container_mb))
+            heaps['namenode'] -= cut_mb
+            heaps['secondarynamenode'] -= cut_mb
+            yarn_mem_mb += 2 * cut_mb
+    if yarn_mem_mb < min_container_mb:
+        return None
+    return yarn_mem_mb
+
+
+def get_gc_opts(daemon, java_version):
+    """
+    Get the GC and GC logging flags for a daemon: a concurrent collector so that large
+    heaps don't stop the daemon for long, with rotated logs of every collection.
+    """
+    gc_log = os.path.join(HADOOP_HOME, 'logs', 'gc-{}.log'.format(daemon))
+    if java_version >= 9:
+        # CMS is deprecated from Java 9 and the old GC logging flags are gone
+        return ['-XX:+UseG1GC', '-XX:MaxGCPauseMillis=200',
+                '-Xlog:gc*:file={}:time,uptime:filecount={},filesize={}'.format(
+                    gc_log, GC_LOG_FILES, GC_LOG_FILE_SIZE)]
+    return ['-XX:+UseParNewGC', '-XX:+UseConcMarkSweepGC',
+            '-XX:CMSInitiatingOccupancyFraction=70', '-XX:+UseCMSInitiatingOccupancyOnly',
+            '-XX:+CMSParallelRemarkEnabled',
+            '-verbose:gc', '-XX:+PrintGCDetails', '-XX:+PrintGCDateStamps',
+            '-Xloggc:' + gc_log, '-XX:+UseGCLogFileRotation',
+            '-XX:NumberOfGCLogFiles={}'.format(GC_LOG_FILES),
+            '-XX:GCLogFileSize={}'.format(GC_LOG_FILE_SIZE)]
+
+
+def write_env_block(env_name, lines):
+    """
+    Replace the block of settings this script manages at the end of an env script,
+    keeping the rest of the script as the AMI has it.
+    """
+    env_file = os.path.join(HADOOP_CONF_DIR, env_name)
+    kept = []
+    if os.path.isfile(env_file):
+        in_block = False
+        with open(env_file) as env:
+            for line in env.read().splitlines():
+                if line == ENV_BLOCK_BEGIN:
+                    in_block = True
+                elif line == ENV_BLOCK_END:
+                    in_block = False
+                elif not in_block:
+                    kept.append(line)
+    with open(env_file, 'w') as env:
+        env.write('\n'.join(kept + [ENV_BLOCK_BEGIN] + lines + [ENV_BLOCK_END]) + '\n')
+    print("Wrote daemon settings to {}".format(env_file))
+
+
+def init_daemon_env(heaps):
+    java_version = get_java_version()
+    blocks = dict((env_name, []) for (env_name, var) in DAEMON_ENV.values())
+    for daemon, heap_mb in sorted(heaps.items()):
+        env_name, var = DAEMON_ENV[daemon]
+        opts = ['-Xms{}m'.format(heap_mb), '-Xmx{}m'.format(heap_mb)]
+        opts += get_gc_opts(daemon, java_version)
+        blocks[env_name].append('export {v}="${v} {o}"'.format(v=var, o=' '.join(opts)))
+    for env_name, lines in sorted(blocks.items()):
+        write_env_block(env_name, lines)
+
+
+def make_domain_socket_dir():
+    # The DataNode refuses a socket path that anyone but itself or root can write to
+    subprocess.check_call(['sudo', 'install', '-d', '-m', '755', '-o', getpass.getuser(),
+                           DFS_DOMAIN_SOCKET_DIR])
+    print("Created directory {}".format(DFS_DOMAIN_SOCKET_DIR))
+
+
+def get_data_dirs():
+    """
+    Mount the node's instance store disks and get a directory on each one for HDFS
+    blocks. Empty on nodes without instance store disks.
+    """
+    output = subprocess.check_output(['bash', MOUNT_DISKS_SCRIPT])
+    return output.decode('utf-8').split()
+
 
 def make_relative_path(path):
     abs_path = os.path.join(HADOOP_HOME, path)
-    os.makedirs(abs_path)
-    print("Created directory {}".format(path))
+    if not os.path.isdir(abs_path):
+        os.makedirs(abs_path)
+        print("Created directory {}".format(path))
     return 'file://' + abs_path
 
 
@@ -48,14 +331,40 @@ def write_conf(conf, conf_name):
     print("Wrote configuration file {}".format(conf_file))
 
 
-def init_core_site(name_node='localhost', access_key_id=None, secret_access_key=None):
+def init_core_site(name_node='localhost', access_key_id=None, secret_access_key=None,
+                   vcores=1, mem_mb=0):
     conf = create_conf()
 
     add_property(conf, 'fs.defaultFS', 'hdfs://{}:9000'.format(name_node))
 
+    if os.path.isfile(TOPOLOGY_DATA):
+        add_property(conf, 'net.topology.script.file.name', TOPOLOGY_SCRIPT)
+
     if access_key_id is not None and secret_access_key is not None:
         add_property(conf, 'fs.s3.awsAccessKeyId', access_key_id)
         add_property(conf, 'fs.s3.awsSecretAccessKey', secret_access_key)
+        add_property(conf, 'fs.s3a.access.key', access_key_id)
+        add_property(conf, 'fs.s3a.secret.key', secret_access_key)
+    else:
+        # No keys were deployed, so use the instance's IAM role
+        add_property(conf, 'fs.s3a.aws.credentials.provider', S3A_INSTANCE_PROFILE_PROVIDER)
+
+    s3a_threads = max(S3A_MIN_THREADS, vcores * S3A_THREADS_PER_VCORE)
+    add_property(conf, 'fs.s3a.impl', 'org.apache.hadoop.fs.s3a.S3AFileSystem')
+    add_property(conf, 'fs.s3a.threads.max', str(s3a_threads))
+    add_property(conf, 'fs.s3a.max.total.tasks', str(s3a_threads))
+    add_property(conf, 'fs.s3a.connection.maximum',
+                 str(max(2 * s3a_threads, vcores * S3A_CONNECTIONS_PER_VCORE)))
+    add_property(conf, 'fs.s3a.fast.upload', 'true')
+    add_property(conf, 'fs.s3a.fast.upload.buffer',
+                 'bytebuffer' if mem_mb >= S3A_MEMORY_BUFFER_MIN_MB else 'disk')
+    add_property(conf, 'fs.s3a.buffer.dir', make_relative_path('data/s3a'))
+    add_property(conf, 'fs.s3a.multipart.size', S3A_MULTIPART_SIZE)
+    add_property(conf, 'fs.s3a.multipart.threshold', S3A_MULTIPART_SIZE)
+    add_property(conf, 'fs.s3a.block.size', S3A_MULTIPART_SIZE)
+    # Columnar formats seek between column chunks, so don't read far ahead of them
+    add_property(conf, 'fs.s3a.experimental.input.fadvise', 'random')
+    add_property(conf, 'fs.s3a.readahead.range', S3A_READAHEAD_RANGE)
 
     write_conf(conf, 'core-site.xml')
 
@@ -83,7 +392,7 @@ def init_yarn_site(name_node='localhost', vcores='64', mem='204800'):
     write_conf(conf, 'yarn-site.xml')
 
 
-def init_mapred_site(name_node='localhost'):
+def init_mapred_site(name_node='localhost', map_output_codec=None):
     conf = create_conf()
 
     add_property(conf, 'mapreduce.jobtracker.address', name_node)
@@ -98,10 +407,16 @@ def init_mapred_site(name_node='localhost'):
     add_property(conf, 'hadoop.proxyuser.mapred.groups', '*')
     add_property(conf, 'hadoop.proxyuser.mapred.hosts', '*')
 
+    if map_output_codec in MAP_OUTPUT_CODECS:
+        add_property(conf, 'mapreduce.map.output.compress', 'true')
+        add_property(conf, 'mapreduce.map.output.compress.codec',
+                     MAP_OUTPUT_CODECS[map_output_codec])
+
     write_conf(conf, 'mapred-site.xml')
 
 
-def init_hdfs_site(is_name_node, is_data_node, name_node='localhost'):
+def init_hdfs_site(is_name_node, is_data_node, name_node='localhost', short_circuit=False,
+                   data_dirs=None):
     conf = create_conf()
 
     add_property(conf, 'dfs.replication', '1')
@@ -112,30 +427,94 @@ def init_hdfs_site(is_name_node, is_data_node, name_node='localhost'):
     if is_name_node:
         add_property(conf, 'dfs.namenode.name.dir', make_relative_path('data/hdfs/namenode'))
 
-    if is_data_node:
+    if is_data_node and data_dirs:
+        add_property(conf, 'dfs.datanode.data.dir',
+                     ','.join('file://' + os.path.join(d, 'hdfs/datanode') for d in data_dirs))
+    elif is_data_node:
         add_property(conf, 'dfs.datanode.data.dir', make_relative_path('data/hdfs/datanode'))
 
+    # Let tasks read blocks stored on their own node straight from disk
+    if short_circuit:
+        if is_data_node:
+            make_domain_socket_dir()
+        add_property(conf, 'dfs.client.read.shortcircuit', 'true')
+        add_property(conf, 'dfs.domain.socket.path', DFS_DOMAIN_SOCKET_PATH)
+
     write_conf(conf, 'hdfs-site.xml')
 
 
 def main():
     parser = OptionParser(
         prog="hadoop-conf",
-        usage="%prog <name-node> <node-type> <aws-access-key-id> <aws-secret-access-key>\n\n")
+        usage="%prog <name-node> <node-type> [<aws-access-key-id> <aws-secret-access-key>]\n"
+              "       %prog --check-native\n\n"
+              "<node-type> names the daemons the node runs besides a NodeManager, e.g.\n"
+              "namenode_datanode or datanode, or is nodemanager for compute-only nodes.")
+
+    parser.add_option(
+        "--expected-blocks", type="int", default=DEFAULT_EXPECTED_BLOCKS,
+        help="Number of HDFS blocks to size the NameNode heap for (default: %default)")
+
+    parser.add_option(
+        "--map-output-codec", type="choice", choices=sorted(MAP_OUTPUT_CODECS) + ['none'],
+        default='none',
+        help="Codec to compress intermediate map output with, which every node in the "
+             "cluster must be able to load: one of snappy, lz4 or none (default: %default)")
+    parser.add_option(
+        "--check-native", action="store_true", default=False,
+        help="Only print which native libraries load on this node, as configure.sh "
+             "collects them to pick --map-output-codec")
 
     (opts, args) = parser.parse_args()
-    if len(args) != 4:
+    if opts.check_native:
+        print("Native libraries: " + format_native_libs(check_native()))
+        return
+    if len(args) not in (2, 4):
         parser.print_help()
         sys.exit(1)
-    (name_node, node_type, aws_access_key_id, aws_secret_access_key) = args
+    (name_node, node_type, aws_access_key_id, aws_secret_access_key) = (args + [None, None])[:4]
 
     is_name_node = 'namenode' in node_type
     is_data_node = 'datanode' in node_type
 
-    init_core_site(name_node, aws_access_key_id, aws_secret_access_key)
-    init_yarn_site(name_node)
-    init_mapred_site(name_node)
-    init_hdfs_site(is_name_node, is_data_node, name_node)
+    vcores, mem_mb = get_node_resources()
+    data_dirs = get_data_dirs() if is_data_node else []
+    fingerprint = get_conf_fingerprint(sys.argv[1:] + data_dirs, vcores, mem_mb)
+    last_fingerprint, last_summary = read_conf_state()
+    if fingerprint == last_fingerprint and os.path.isdir(os.path.join(HADOOP_HOME, 'data')):
+        print("Configuration inputs unchanged since last run: skipping")
+        print(last_summary)
+        return
+
+    heaps = get_daemon_heaps(node_type, mem_mb, opts.expected_blocks)
+    yarn_mem_mb = get_yarn_memory_mb(mem_mb, heaps)
+    if yarn_mem_mb is None:
+        print("Error: this node's {m} MB of memory can't hold the OS reserve, its daemon heaps "
+              "({h} MB) and a {c} MB YARN container. Use a larger instance type.".format(
+                  m=mem_mb, h=sum(heaps.values()), c=YARN_MINIMUM_ALLOCATION_MB))
+        sys.exit(1)
+
+    native_libs = check_native()
+    # Short-circuit reads need libhadoop for the domain socket, and a local DataNode to
+    # read from, which compute-only nodes don't run
+    short_circuit = native_libs.get('hadoop', False) and is_data_node
+
+    init_core_site(name_node, aws_access_key_id, aws_secret_access_key, vcores, mem_mb)
+    init_yarn_site(name_node, str(vcores), str(yarn_mem_mb))
+    init_mapred_site(name_node, opts.map_output_codec)
+    init_hdfs_site(is_name_node, is_data_node, name_node, short_circuit, data_dirs)
+    if is_data_node:
+        print("HDFS data dirs: " + (', '.join(data_dirs) or 'none mounted, using ' + HADOOP_HOME))
+    init_daemon_env(heaps)
+    print("Daemon heaps: " + ' '.join('{}={}m'.format(d, h) for d, h in sorted(heaps.items())))
+
+    # One line per node for setup.sh to collect into its summary
+    summary = "Native libraries: {libs}; short-circuit reads {sc}; map output codec {c}".format(
+        libs=format_native_libs(native_libs),
+        sc='enabled' if short_circuit else 'disabled',
+        c=opts.map_output_codec)
+    print(summary)
+    write_conf_state(fingerprint, summary)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# Configure the new slaves and start a NodeManager on each, and a DataNode on each that
+# isn't compute-only
+
+source ${HOME}/hadoop-ec2/hadoop/common.sh
+
+# Configured with the map output codec the rest of the cluster uses
+MAP_OUTPUT_CODEC=`cat ${MAP_OUTPUT_CODEC_FILE} 2>/dev/null || echo none`
+
+write_slaves_files
+
+for node in ${NEW_SLAVES}; do
+  echo "Starting slave node: ${node}"
+  node_type=`get_node_type ${node}`
+  start_datanode="${HADOOP_HOME}/sbin/hadoop-daemon.sh start datanode &&"
+  if [[ "${node_type}" == "nodemanager" ]]; then
+    start_datanode=""
+  fi
+  ssh -t -t ${SSH_OPTS} ubuntu@${node} "source ~/.bash_profile;
+    hadoop-ec2/hadoop/hadoop-conf.py --map-output-codec ${MAP_OUTPUT_CODEC} ${ACTIVE_MASTER} ${node_type} ${AWS_KEYS} &&
+    ${start_datanode}
+    ${HADOOP_HOME}/sbin/yarn-daemon.sh start nodemanager" & sleep 0.3
+done
+wait
@@ -0,0 +1,39 @@
+#!/bin/bash
+
+# Format and mount the node's instance store disks, and print a directory on each one
+# for HDFS blocks, one per line. Disks already mounted at /mnt, where the first one
+# usually is, or under /data are used where they are. Instance store is wiped when an
+# instance stops, so this runs again on every configuration.
+
+DATA_MOUNT_ROOT=/data
+
+ROOT_SOURCE=`findmnt -n -o SOURCE /`
+ROOT_DISK=`lsblk -n -o PKNAME ${ROOT_SOURCE} 2>/dev/null | head -1`
+ROOT_DISK=${ROOT_DISK:-`basename ${ROOT_SOURCE}`}
+
+for disk in `lsblk -d -n -o NAME,TYPE | awk '$2 == "disk" {print $1}' | grep -E '^(xvd|sd|nvme)'`; do
+  if [[ "${disk}" == "${ROOT_DISK}" ]] || swapon --show=NAME --noheadings | grep -qxF "/dev/${disk}"; then
+    continue
+  fi
+  # EBS volumes attached by hand are not ours to format
+  if grep -q "Elastic Block Store" /sys/block/${disk}/device/model 2>/dev/null; then
+    continue
+  fi
+  # Nor are disks someone partitioned
+  if [[ `lsblk -n -o NAME /dev/${disk} | wc -l` -gt 1 ]]; then
+    continue
+  fi
+
+  mount_point=`lsblk -n -o MOUNTPOINT /dev/${disk} | head -1`
+  if [[ -n "${mount_point}" && "${mount_point}" != /mnt && "${mount_point}" != ${DATA_MOUNT_ROOT}/* ]]; then
+    continue
+  elif [[ -z "${mount_point}" ]]; then
+    mount_point=${DATA_MOUNT_ROOT}/${disk}
+    echo "Formatting /dev/${disk} for ${mount_point}" >&2
+    sudo mkfs.ext4 -q -F -m 0 -E nodiscard /dev/${disk} >&2 || continue
+    sudo mkdir -p ${mount_point}
+    sudo mount -o defaults,noatime /dev/${disk} ${mount_point} >&2 || continue
+  fi
+  sudo install -d -o `whoami` ${mount_point}/hadoop
+  echo ${mount_point}/hadoop
+done
@@ -0,0 +1,9 @@
+#!/bin/bash
+
+HADOOP_HOME=/usr/local/hadoop
+
+echo "Starting HDFS..."
+${HADOOP_HOME}/sbin/start-dfs.sh
+
+# Steps that write to HDFS run after this one, and must not find it in safe mode
+${HADOOP_HOME}/bin/hdfs dfsadmin -safemode wait
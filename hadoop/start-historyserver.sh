@@ -0,0 +1,7 @@
+#!/bin/bash
+
+HADOOP_HOME=/usr/local/hadoop
+HADOOP_CONF_DIR=${HADOOP_HOME}/etc/hadoop
+
+echo "Starting History Server..."
+${HADOOP_HOME}/sbin/mr-jobhistory-daemon.sh --config ${HADOOP_CONF_DIR} start historyserver
@@ -0,0 +1,6 @@
+#!/bin/bash
+
+HADOOP_HOME=/usr/local/hadoop
+
+echo "Starting YARN..."
+HADOOP_SLAVES=${HADOOP_HOME}/etc/hadoop/yarn-slaves ${HADOOP_HOME}/sbin/start-yarn.sh
@@ -0,0 +1,13 @@
+#!/bin/bash
+
+# Topology script for net.topology.script.file.name: prints the rack of each host
+# name or IP address given, as recorded by the launcher in topology.data.
+
+TOPOLOGY_DATA=${HOME}/hadoop-ec2/topology.data
+DEFAULT_RACK=/default-zone/default-rack
+
+for node in "$@"; do
+  rack=`awk -v node="${node}" '$1 == node { print $2; exit }' ${TOPOLOGY_DATA} 2> /dev/null`
+  echo -n "${rack:-${DEFAULT_RACK}} "
+done
+echo
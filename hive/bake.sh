@@ -0,0 +1,30 @@
+#!/bin/bash
+
+HIVE_HOME=/usr/local/hive
+
+# The metastore's tables point into this cluster's HDFS. Clusters launched from the
+# image skip schema init, so the image keeps an empty metastore with a current schema.
+read METASTORE_HOST METASTORE_DB METASTORE_USER METASTORE_PASSWORD < <(python - <<'EOF'
+import re
+import xml.etree.ElementTree as ETree
+
+props = dict((prop.findtext('name'), prop.findtext('value') or '')
+             for prop in ETree.parse('/usr/local/hive/conf/hive-site.xml').iter('property'))
+url = re.match(r'jdbc:mysql://([^/:]+)[^/]*/([^?;]+)',
+               props.get('javax.jdo.option.ConnectionURL', ''))
+if url:
+    print(url.group(1), url.group(2),
+          props.get('javax.jdo.option.ConnectionUserName', 'root'),
+          props.get('javax.jdo.option.ConnectionPassword', ''))
+EOF
+)
+if [[ -n "${METASTORE_DB}" ]]; then
+  echo "Emptying Hive metastore database ${METASTORE_DB}..."
+  MYSQL_PWD=${METASTORE_PASSWORD} mysql -h ${METASTORE_HOST} -u ${METASTORE_USER} \
+    -e "DROP DATABASE IF EXISTS \`${METASTORE_DB}\`; CREATE DATABASE \`${METASTORE_DB}\`" &&
+    $HIVE_HOME/bin/schematool -dbType mysql -initSchema
+fi
+
+# Hive clients run without hive-site.xml leave an embedded Derby metastore behind
+rm -rf ${HOME}/metastore_db ${HOME}/derby.log
+rm -f ${HOME}/.hadoop-ec2-state/hive-schema
@@ -0,0 +1,3 @@
+#!/bin/bash
+
+${HOME}/hadoop-ec2/hive/hive-conf.py
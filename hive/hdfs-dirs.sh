@@ -0,0 +1,7 @@
+#!/bin/bash
+
+HADOOP_HOME=/usr/local/hadoop
+
+# One JVM launch per command, covering all the directories at once
+$HADOOP_HOME/bin/hadoop fs -mkdir -p /tmp /user/hive/warehouse
+$HADOOP_HOME/bin/hadoop fs -chmod g+w /tmp /user/hive/warehouse
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import sys
+import xml.etree.ElementTree as ETree
+from optparse import OptionParser
+from xml.dom import minidom
+import os
+
+HIVE_HOME = os.getenv('HIVE_HOME', '/usr/local/hive')
+HIVE_CONF_DIR = os.getenv('HIVE_CONF_DIR', os.path.join(HIVE_HOME, 'conf'))
+
+HIVE_DEFAULT_FILE_FORMAT = 'ORC'
+HIVE_MIN_PARALLEL_THREADS = 8
+METASTORE_CONNECTION_POOL_TYPE = 'BONECP'
+METASTORE_CONNECTION_POOL_SIZE = '20'
+
+
+def load_conf(conf_name):
+    """
+    Load an existing configuration file, so that settings made on the AMI (such as the
+    metastore database connection) are kept, or start a new one.
+    """
+    conf_file = os.path.join(HIVE_CONF_DIR, conf_name)
+    if not os.path.isfile(conf_file):
+        return ETree.Element('configuration')
+    conf = ETree.parse(conf_file).getroot()
+    # Drop the old indentation so that the file is pretty-printed cleanly again
+    for elem in conf.iter():
+        if elem.text is not None and not elem.text.strip():
+            elem.text = None
+        elem.tail = None
+    return conf
+
+
+def set_property(conf, name, value):
+    for prop in conf.findall('property'):
+        if prop.findtext('name') == name:
+            prop_value = prop.find('value')
+            if prop_value is None:
+                prop_value = ETree.SubElement(prop, 'value')
+            prop_value.text = value
+            return
+    prop = ETree.SubElement(conf, 'property')
+    prop_name = ETree.SubElement(prop, 'name')
+    prop_name.text = name
+    prop_value = ETree.SubElement(prop, 'value')
+    prop_value.text = value
+
+
+def write_conf(conf, conf_name):
+    conf_data = ETree.tostring(conf, 'utf-8')
+    conf_file = os.path.join(HIVE_CONF_DIR, conf_name)
+    hive_site = open(conf_file, 'w')
+    hive_site.write(minidom.parseString(conf_data).toprettyxml(indent='  '))
+    hive_site.close()
+    print("Wrote configuration file {}".format(conf_file))
+
+
+def init_hive_site(parallel_threads):
+    conf = load_conf('hive-site.xml')
+
+    # Vectorized execution over a columnar default format
+    set_property(conf, 'hive.vectorized.execution.enabled', 'true')
+    set_property(conf, 'hive.vectorized.execution.reduce.enabled', 'true')
+    set_property(conf, 'hive.default.fileformat', HIVE_DEFAULT_FILE_FORMAT)
+    set_property(conf, 'hive.default.fileformat.managed', HIVE_DEFAULT_FILE_FORMAT)
+
+    # Cost-based optimization, fed by statistics gathered as tables are written
+    set_property(conf, 'hive.cbo.enable', 'true')
+    set_property(conf, 'hive.compute.query.using.stats', 'true')
+    set_property(conf, 'hive.stats.autogather', 'true')
+    set_property(conf, 'hive.stats.column.autogather', 'true')
+    set_property(conf, 'hive.stats.fetch.column.stats', 'true')
+    set_property(conf, 'hive.stats.fetch.partition.stats', 'true')
+
+    # Run independent stages of a query at the same time
+    set_property(conf, 'hive.exec.parallel', 'true')
+    set_property(conf, 'hive.exec.parallel.thread.number', str(parallel_threads))
+
+    # Pool metastore database connections instead of opening one per request
+    set_property(conf, 'datanucleus.connectionPoolingType', METASTORE_CONNECTION_POOL_TYPE)
+    set_property(conf, 'datanucleus.connectionPool.maxPoolSize', METASTORE_CONNECTION_POOL_SIZE)
+
+    write_conf(conf, 'hive-site.xml')
+
+
+def main():
+    parser = OptionParser(
+        prog="hive-conf",
+        usage="%prog\n\n")
+
+    (opts, args) = parser.parse_args()
+    if len(args) != 0:
+        parser.print_help()
+        sys.exit(1)
+
+    init_hive_site(max(HIVE_MIN_PARALLEL_THREADS, multiprocessing.cpu_count()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+#!/bin/bash
+
+HIVE_HOME=/usr/local/hive
+
+# The metastore schema is kept on AMIs registered by bake-ami, and in the metastore
+# database across stop/start. Once checked against this Hive install it isn't checked
+# again, which saves starting schematool on every restart.
+HIVE_SCHEMA_MARKER=${HADOOP_EC2_STATE}/hive-schema
+HIVE_METASTORE_JARS=`ls ${HIVE_HOME}/lib/hive-metastore-*.jar 2>/dev/null`
+if [[ "${BAKED_IMAGE}" == "true" ]]; then
+  echo "Hive metastore schema already initialized on baked image: skipping"
+elif [[ -n "${HIVE_METASTORE_JARS}" ]] && [[ "`cat ${HIVE_SCHEMA_MARKER} 2>/dev/null`" == "${HIVE_METASTORE_JARS}" ]]; then
+  echo "Hive metastore schema checked since last Hive install: skipping"
+elif SCHEMA_INFO=`$HIVE_HOME/bin/schematool -dbType mysql -info 2>&1`; then
+  HIVE_VERSION=`echo "${SCHEMA_INFO}" | grep "Hive distribution version" | awk -F: '{print $2}' | tr -d ' '`
+  SCHEMA_VERSION=`echo "${SCHEMA_INFO}" | grep "Metastore schema version" | awk -F: '{print $2}' | tr -d ' '`
+  if [[ "${HIVE_VERSION}" == "${SCHEMA_VERSION}" ]]; then
+    echo "Hive metastore schema ${SCHEMA_VERSION} is current: skipping"
+    echo "${HIVE_METASTORE_JARS}" > ${HIVE_SCHEMA_MARKER}
+  else
+    echo "Upgrading Hive metastore schema from ${SCHEMA_VERSION} to ${HIVE_VERSION}..."
+    $HIVE_HOME/bin/schematool -dbType mysql -upgradeSchema &&
+      echo "${HIVE_METASTORE_JARS}" > ${HIVE_SCHEMA_MARKER}
+  fi
+else
+  echo "Initializing Hive metastore schema..."
+  $HIVE_HOME/bin/schematool -dbType mysql -initSchema &&
+    echo "${HIVE_METASTORE_JARS}" > ${HIVE_SCHEMA_MARKER}
+fi
@@ -0,0 +1,40 @@
+#!/bin/bash
+
+# Join new slaves to the running cluster. The launcher has already deployed cluster files
+# that list them, which are synced to every node along with their hosts entries before
+# each module starts its daemons on the new slaves.
+# usage: join.sh <slave>...
+
+pushd ${HOME}/hadoop-ec2 > /dev/null
+
+source ${HOME}/.bashrc
+source ${HOME}/.bash_profile
+source ec2-variables.sh
+
+export NEW_SLAVES="$@"
+
+echo "${MASTERS}" > masters
+echo "${SLAVES}" > slaves
+
+export OTHER_MASTERS=`cat masters | sed '1d'`
+export ACTIVE_MASTER=`cat masters | head -1`
+export SSH_OPTS="-o StrictHostKeyChecking=no -o ConnectTimeout=5"
+
+bash ./update-hosts.sh
+
+echo "RSYNC'ing ${HOME}/hadoop-ec2 and /etc/hosts to all cluster nodes..."
+for node in ${SLAVES} ${OTHER_MASTERS}; do
+  (rsync -e "ssh ${SSH_OPTS}" -az ${HOME}/hadoop-ec2 ${node}:${HOME} &&
+    ssh ${SSH_OPTS} ${node} "bash hadoop-ec2/update-hosts.sh") &
+  sleep 0.1
+done
+wait
+
+for module in ${MODULES}; do
+  if [[ -e ${module}/join.sh ]]; then
+    echo "Joining new slaves to $module"
+    bash ${module}/join.sh
+  fi
+done
+
+popd > /dev/null
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import subprocess
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+HADOOP_EC2_DIR = os.path.dirname(os.path.realpath(__file__))
+HADOOP_EC2_STATE = os.path.join(os.path.expanduser('~'), '.hadoop-ec2-state')
+
+# Each module lists its steps in this file, one "<step> <script> [<depends on>...]" per
+# line. Dependencies on steps of other modules are written "<module>/<step>".
+STEPS_FILE = 'steps'
+
+# Steps with this name install software on the node itself. They are already done on
+# images registered by bake-ami, and when the same script ran on this node before.
+INIT_STEP = 'init'
+
+
+class Step(object):
+    def __init__(self, module, name, script, deps):
+        self.module = module
+        self.name = name
+        self.id = module + '/' + name
+        self.script = os.path.join(module, script)
+        self.deps = [dep if '/' in dep else module + '/' + dep for dep in deps]
+        self.status = None  # one of 'ok', 'failed', 'blocked' once decided
+        self.start_time = None
+        self.end_time = None
+
+    def duration(self):
+        return self.end_time - self.start_time
+
+
+def load_steps(module):
+    """
+    Load a module's steps from its steps file. Modules without one get an init step and
+    a setup step run after it, from init.sh and setup.sh.
+    """
+    steps_file = os.path.join(HADOOP_EC2_DIR, module, STEPS_FILE)
+    if not os.path.isfile(steps_file):
+        steps = [Step(module, 'setup', 'setup.sh', [])]
+        if os.path.isfile(os.path.join(HADOOP_EC2_DIR, module, 'init.sh')):
+            steps.insert(0, Step(module, INIT_STEP, 'init.sh', []))
+            steps[1].deps.append(steps[0].id)
+        return steps
+
+    steps = []
+    with open(steps_file) as manifest:
+        for line in manifest:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                steps.append(Step(module, fields[0], fields[1], fields[2:]))
+    return steps
+
+
+def check_steps(steps):
+    """
+    Drop dependencies on modules that aren't being set up, and exit if a dependency is
+    unknown or the dependencies form a cycle.
+    """
+    by_id = dict((step.id, step) for step in steps)
+    modules = set(step.module for step in steps)
+    for step in steps:
+        for dep in step.deps:
+            if dep.split('/')[0] in modules and dep not in by_id:
+                print("ERROR: {s} depends on unknown step {d}".format(s=step.id, d=dep))
+                sys.exit(1)
+        step.deps = [dep for dep in step.deps if dep in by_id]
+
+    visiting = set()
+    done = set()
+
+    def visit(step, chain):
+        if step.id in done:
+            return
+        if step.id in visiting:
+            print("ERROR: Steps depend on each other in a cycle: " + ' -> '.join(chain))
+            sys.exit(1)
+        visiting.add(step.id)
+        for dep in step.deps:
+            visit(by_id[dep], chain + [dep])
+        visiting.discard(step.id)
+        done.add(step.id)
+
+    for step in steps:
+        visit(step, [step.id])
+
+
+def get_init_digest(step):
+    with open(os.path.join(HADOOP_EC2_DIR, step.script), 'rb') as script:
+        return hashlib.md5(script.read()).hexdigest()
+
+
+def is_init_done(step):
+    if os.getenv('BAKED_IMAGE') == 'true':
+        return True
+    marker = os.path.join(HADOOP_EC2_STATE, 'init-' + step.module)
+    if not os.path.isfile(marker):
+        return False
+    with open(marker) as done:
+        return done.read().strip() == get_init_digest(step)
+
+
+def run_step(step, output_lock):
+    """
+    Run a step's script, printing its output line by line prefixed with the step.
+    """
+    if step.name == INIT_STEP and is_init_done(step):
+        with output_lock:
+            print("[{s}] already done on this node: skipping".format(s=step.id))
+        return True
+
+    proc = subprocess.Popen(['bash', step.script], cwd=HADOOP_EC2_DIR,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in iter(proc.stdout.readline, b''):
+        with output_lock:
+            sys.stdout.write("[{s}] {l}\n".format(
+                s=step.id, l=line.decode('utf-8', 'replace').rstrip('\r\n')))
+            sys.stdout.flush()
+    if proc.wait() != 0:
+        return False
+
+    if step.name == INIT_STEP:
+        with open(os.path.join(HADOOP_EC2_STATE, 'init-' + step.module), 'w') as done:
+            done.write(get_init_digest(step) + '\n')
+    return True
+
+
+def run_steps(steps):
+    """
+    Run every step as soon as all the steps it depends on have succeeded. Steps that
+    depend on a failed step are not run.
+    """
+    by_id = dict((step.id, step) for step in steps)
+    pending = list(steps)
+    running = [0]
+    scheduler = threading.Condition()
+    output_lock = threading.Lock()
+
+    def run(step):
+        step.start_time = time.time()
+        try:
+            ok = run_step(step, output_lock)
+        except Exception as e:
+            with output_lock:
+                print("[{s}] {e}".format(s=step.id, e=e))
+            ok = False
+        step.end_time = time.time()
+        with scheduler:
+            step.status = 'ok' if ok else 'failed'
+            running[0] -= 1
+            scheduler.notify()
+
+    with scheduler:
+        while pending or running[0]:
+            for step in list(pending):
+                dep_statuses = [by_id[dep].status for dep in step.deps]
+                if any(status in ['failed', 'blocked'] for status in dep_statuses):
+                    step.status = 'blocked'
+                    pending.remove(step)
+                elif all(status == 'ok' for status in dep_statuses):
+                    pending.remove(step)
+                    running[0] += 1
+                    threading.Thread(target=run, args=(step,)).start()
+            if running[0]:
+                scheduler.wait()
+
+
+def get_critical_path(steps):
+    """
+    Follow the steps that finished last back from the last one to finish: the chain
+    of steps that the total setup time was spent waiting on.
+    """
+    by_id = dict((step.id, step) for step in steps)
+    finished = [step for step in steps if step.end_time is not None]
+    if not finished:
+        return []
+    path = [max(finished, key=lambda step: step.end_time)]
+    while path[-1].deps:
+        path.append(max((by_id[dep] for dep in path[-1].deps), key=lambda step: step.end_time))
+    return list(reversed(path))
+
+
+def format_duration(seconds):
+    return time.strftime('%Hh %Mm %Ss', time.gmtime(seconds))
+
+
+def print_report(steps, total_seconds):
+    for step in sorted(steps, key=lambda step: step.start_time or float('inf')):
+        if step.status == 'blocked':
+            print("[timing] {s}: not run, a step it depends on failed".format(s=step.id))
+        else:
+            print("[timing] {s}: {t}{f}".format(
+                s=step.id, t=format_duration(step.duration()),
+                f=' (failed)' if step.status == 'failed' else ''))
+    path = get_critical_path(steps)
+    print("[timing] critical path: " + ' -> '.join(
+        "{s} ({t:.0f}s)".format(s=step.id, t=step.duration()) for step in path))
+    print("[timing] all steps: {t}, of which {c} on the critical path".format(
+        t=format_duration(total_seconds),
+        c=format_duration(sum(step.duration() for step in path))))
+
+
+def main():
+    parser = OptionParser(
+        prog="run-steps",
+        usage="%prog <module>...\n\n"
+              "Run the init and setup steps of the modules, each as soon as the steps it\n"
+              "depends on have finished, and report how long each took.")
+
+    (opts, modules) = parser.parse_args()
+    if not modules:
+        parser.print_help()
+        sys.exit(1)
+
+    if not os.path.isdir(HADOOP_EC2_STATE):
+        os.makedirs(HADOOP_EC2_STATE)
+
+    steps = []
+    for module in modules:
+        steps.extend(load_steps(module))
+    check_steps(steps)
+
+    start_time = time.time()
+    run_steps(steps)
+    print_report(steps, time.time() - start_time)
+
+    if any(step.status != 'ok' for step in steps):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
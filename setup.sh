@@ -24,11 +24,13 @@ echo "Slaves: ${SLAVES}"
 # Set hostname based on EC2 private DNS name, so that it is set correctly
 # even if the instance is restarted with a different private DNS name
 PRIVATE_DNS=`wget -q -O - http://169.254.169.254/latest/meta-data/local-hostname`
-PUBLIC_DNS=`wget -q -O - http://169.254.169.254/latest/meta-data/hostname`
 sudo hostname ${PRIVATE_DNS}
 echo ${PRIVATE_DNS} | sudo tee /etc/hostname
 export HOSTNAME=${PRIVATE_DNS}  # Fix the bash built-in hostname variable too
 
+# Resolve the other nodes' private names from /etc/hosts rather than DNS
+bash ./update-hosts.sh
+
 echo "Setting up Hadoop on `hostname`..."
 
 # Set up the masters, slaves, etc files based on cluster env variables
@@ -38,9 +40,24 @@ echo "${SLAVES}" > slaves
 MASTERS=`cat masters`
 NUM_MASTERS=`cat masters | wc -l`
 OTHER_MASTERS=`cat masters | sed '1d'`
+# What the other nodes reach this master at, per the launcher's --cluster-addressing
+ACTIVE_MASTER=`cat masters | head -1`
 SLAVES=`cat slaves`
 SSH_OPTS="-o StrictHostKeyChecking=no -o ConnectTimeout=5"
 
+# The module steps run as their own processes
+export MASTERS SLAVES OTHER_MASTERS ACTIVE_MASTER SSH_OPTS
+
+# Markers of the setup work already done on this node. They are kept outside the
+# rsynced tree, so that setting up a restarted cluster only redoes what changed.
+export HADOOP_EC2_STATE=${HOME}/.hadoop-ec2-state
+mkdir -p ${HADOOP_EC2_STATE}
+echo "${SCRIPTS_VERSION}" > ${HADOOP_EC2_STATE}/scripts-version
+
+# The other nodes are current if the same instances are at the same addresses with the
+# same scripts as when they were last synced, all of which the deployed files record
+CLUSTER_FINGERPRINT=`cat ec2-variables.sh topology.data hosts | md5sum | cut -d' ' -f1`
+
 if [[ "x${JAVA_HOME}" == "x" ]] ; then
     echo "Expected JAVA_HOME to be set in .bash_profile!"
     exit 1
@@ -54,39 +71,37 @@ fi
 echo "Setting executable permissions on scripts..."
 find . -regex "^.+.\(sh\|py\)" | xargs chmod a+x
 
-echo "RSYNC'ing ${HOME}/hadoop-ec2 to other cluster nodes..."
-rsync_start_time="$(date +'%s')"
-for node in ${SLAVES} ${OTHER_MASTERS}; do
-  echo ${node}
-  rsync -e "ssh ${SSH_OPTS}" -az ${HOME}/hadoop-ec2 ${node}:${HOME} &
-  scp ${SSH_OPTS} ~/.ssh/id_rsa ${node}:.ssh &
-  sleep 0.1
-done
-wait
-rsync_end_time="$(date +'%s')"
-echo_time_diff "rsync ${HOME}/hadoop-ec2" "$rsync_start_time" "$rsync_end_time"
-
-# Install / Init module
-for module in ${MODULES}; do
-  echo "Initializing $module"
-  module_init_start_time="$(date +'%s')"
-  if [[ -e ${module}/init.sh ]]; then
-    source ${module}/init.sh
+if [[ "`cat ${HADOOP_EC2_STATE}/cluster 2>/dev/null`" == "${CLUSTER_FINGERPRINT}" ]]; then
+  echo "Cluster nodes and scripts unchanged since last setup: skipping rsync"
+else
+  echo "RSYNC'ing ${HOME}/hadoop-ec2 and /etc/hosts to other cluster nodes..."
+  rsync_start_time="$(date +'%s')"
+  rsync_pids=""
+  for node in ${SLAVES} ${OTHER_MASTERS}; do
+    echo ${node}
+    (rsync -e "ssh ${SSH_OPTS}" -az ${HOME}/hadoop-ec2 ${node}:${HOME} &&
+      ssh ${SSH_OPTS} ${node} "bash hadoop-ec2/update-hosts.sh") &
+    rsync_pids="${rsync_pids} $!"
+    scp ${SSH_OPTS} ~/.ssh/id_rsa ${node}:.ssh &
+    rsync_pids="${rsync_pids} $!"
+    sleep 0.1
+  done
+  rsync_failed=false
+  for pid in ${rsync_pids}; do
+    wait ${pid} || rsync_failed=true
+  done
+  if [[ "${rsync_failed}" == "false" ]]; then
+    echo "${CLUSTER_FINGERPRINT}" > ${HADOOP_EC2_STATE}/cluster
   fi
-  module_init_end_time="$(date +'%s')"
-  echo_time_diff "$module init" "$module_init_start_time" "$module_init_end_time"
-  cd ${HOME}/hadoop-ec2  # guard against init.sh changing the cwd
-done
-
-# Setup each module
-for module in ${MODULES}; do
-  echo "Setting up $module"
-  module_setup_start_time="$(date +'%s')"
-  source ./${module}/setup.sh
-  sleep 0.1
-  module_setup_end_time="$(date +'%s')"
-  echo_time_diff "$module setup" "$module_setup_start_time" "$module_setup_end_time"
-  cd ${HOME}/hadoop-ec2  # guard against setup.sh changing the cwd
-done
+  rsync_end_time="$(date +'%s')"
+  echo_time_diff "rsync ${HOME}/hadoop-ec2" "$rsync_start_time" "$rsync_end_time"
+fi
+
+# Run the modules' init and setup steps, each as soon as the steps it depends on are
+# done, across modules. Init steps are skipped on AMIs registered by bake-ami.
+if ! ./run-steps.py ${MODULES}; then
+  echo "Some setup steps failed, see above"
+  exit 1
+fi
 
 popd > /dev/null
\ No newline at end of file
@@ -0,0 +1,16 @@
+#!/bin/bash
+
+# Replace the hadoop-ec2 block in /etc/hosts with the cluster addresses in
+# ~/hadoop-ec2/hosts, so that nodes resolve each other's private names without going
+# through DNS. Running it again swaps in the current addresses.
+
+HOSTS_BEGIN="# BEGIN hadoop-ec2 cluster"
+HOSTS_END="# END hadoop-ec2 cluster"
+
+NEW_HOSTS=`mktemp`
+sed "/^${HOSTS_BEGIN}\$/,/^${HOSTS_END}\$/d" /etc/hosts > ${NEW_HOSTS}
+echo "${HOSTS_BEGIN}" >> ${NEW_HOSTS}
+cat ${HOME}/hadoop-ec2/hosts >> ${NEW_HOSTS}
+echo "${HOSTS_END}" >> ${NEW_HOSTS}
+sudo cp ${NEW_HOSTS} /etc/hosts
+rm -f ${NEW_HOSTS}